@@ -20,99 +20,261 @@
 from mpi4py import MPI
 import numpy as np
 from enum import Enum
-from threading import Lock, Thread
-import logging, os, sys, time, macfile, argparse
+from threading import Lock, Thread, Semaphore
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import logging, os, sys, time, macfile, argparse, pathlib, shutil
 from utils import *
 #import SimpleITK as sitk
 from imageio import stack_images
+from logger import get_log, close_log
 
 sys.excepthook = global_except_hook
+
+# Reads all the images of an output file and deletes it. It runs on the reader threads, if any.
+def read_and_remove(output_filepath):
+    stack = stack_images(output_filepath).get_stack()
+    os.remove(output_filepath)
+    return stack
     
 class collector:
     
-    def __init__(self, logFolder):
-        self.log = open(os.path.join(logFolder,'collector.log'), "w") 
+    def __init__(self, logFolder, n_readers=1, n_writers=1, topup_dir=None, noise_roi=None, output_backend='itk', n_projs=None, get_metadata=None, perf=None):
+        self.log = get_log('collector', os.path.join(logFolder,'collector.log'))
         self.write_log('init')
-        self.images = {}
+        # With more than one reader, the output files are decoded concurrently by a pool of threads (ITK releases 
+        # the GIL while decoding), whereas the accumulation stays on the calling thread
+        self.n_readers = n_readers
+        self.readers = ThreadPoolExecutor(max_workers=n_readers) if n_readers > 1 else None
+        # Merged projections (and ROOT merges) are written behind by a pool of n_writers threads. At most 2*n_writers 
+        # projections can wait to be written: further calls to process_WRITE block until one of them is done.
+        self.writers = ThreadPoolExecutor(max_workers=n_writers)
+        self.pending_writes = Semaphore(2*n_writers)
+        self.images = {} # queue slot -> list of float64 accumulators, one per output image
+        self.dtypes = {} # queue slot -> list of the dtypes of the output images, restored when writing
+        self.received = {} # (subSim, proj) -> (images received over MPI, used instead of the output files, their dtypes)
+        self.topup_dir = topup_dir # top-up runs add the merged outputs of the previous runs, moved here
+        # With a region of interest (x0, x1, y0, y1; None for the whole image), the mean and the variance over the 
+        # subSims of the first output image are tracked, to estimate the noise of the projections
+        self.noise_roi = (Ellipsis, slice(noise_roi[2], noise_roi[3]), slice(noise_roi[0], noise_roi[1])) if noise_roi is not None else None
+        self.noise_stats = {} # queue slot -> [number of subSims, mean, sum of squared deviations] (Welford)
+        # With a container backend ('npy' or 'hdf5'), the merged outputs are written by index (the projection) in 
+        # containers next to the folders of the projections, with n_projs slots (see get_container_path), along with 
+        # the metadata of the projection returned by get_metadata, if given
+        self.output_backend = output_backend
+        self.n_projs = n_projs
+        self.get_metadata = get_metadata
+        self.containers = {} # (path, options) -> stack_images, shared by the writers
+        self.container_lock = Lock()
+        self.perf = perf # perf_recorder, if the run is timed
         self.file_exts = None
         
-    def write_log(self, message):
-        self.log.write(getTimeString()+': ' +message+'\n')
-        self.log.flush()
+    def write_log(self, message, *args):
+        self.log.info(message, *args)
         
                 
+    # The images are written with the given dtypes (by default, their own): e.g. the double precision sums of a group
+    def store_images(self, subSim, proj, images, dtypes=None):
+        self.received[(subSim, proj)] = (images, dtypes if dtypes is not None else [image.dtype for image in images])
+
+    # Adds one image to the double precision accumulator of the given queue slot and output. Accumulators are
+    # allocated once per projection, so memory does not depend on the number of subSims being read.
+    def accumulate(self, queue_n, j, image, dtype=None):
+        accumulators = self.images.setdefault(str(queue_n), [])
+        dtypes = self.dtypes.setdefault(str(queue_n), [])
+        if j == len(accumulators):
+            accumulators.append(np.zeros(image.shape, dtype=np.float64))
+            dtypes.append(np.dtype(dtype) if dtype is not None else image.dtype)
+        if self.perf is not None:
+            start = time.time()
+            np.add(accumulators[j], image, out=accumulators[j])
+            self.perf.count(sum_time=time.time()-start, images_read=1, bytes_read=image.nbytes)
+        else:
+            np.add(accumulators[j], image, out=accumulators[j])
+        if j == 0 and self.noise_roi is not None:
+            self.update_noise(queue_n, image)
+
+    # Welford's online update of the mean and of the sum of squared deviations of the region of interest
+    def update_noise(self, queue_n, image):
+        n, mean, m2 = self.noise_stats.get(str(queue_n), (0, 0., 0.))
+        sample = image[self.noise_roi].astype(np.float64)
+        n += 1
+        delta = sample-mean
+        mean = mean+delta/n
+        m2 = m2+delta*(sample-mean)
+        self.noise_stats[str(queue_n)] = [n, mean, m2]
+
+    # Returns the number of subSims read for the queue slot and the relative noise of their sum: the relative 
+    # standard error of the mean, averaged over the pixels of the region of interest with a positive mean (None 
+    # with less than two subSims)
+    def get_relative_noise(self, queue_n):
+        n, mean, m2 = self.noise_stats.get(str(queue_n), (0, 0., 0.))
+        if n < 2:
+            return n, None
+        valid = mean > 0
+        if not np.any(valid):
+            return n, np.inf
+        std_err = np.sqrt(m2[valid]/(n-1)/n)
+        return n, float(np.mean(std_err/mean[valid]))
+
     def process_READ(self, queue_n, macfile):
         output_filepaths = getOutputImageFiles(macfile)
-        images = []
-        for output_filepath in output_filepaths:
-            reader = stack_images(output_filepath)
-            images.append(reader.get_stack())
+        for j, output_filepath in enumerate(output_filepaths):
+            for image in stack_images(output_filepath).get_stack():
+                self.accumulate(queue_n, j, image)
             os.remove(output_filepath)
-        stored_image = self.images.get(str(queue_n), None)
-        if stored_image is None:
-            self.images[str(queue_n)] = images
-        else:
-            for i,image in enumerate(images):
-                self.images[str(queue_n)][i] = image + stored_image[i]
                 
     def process_multiREAD(self, queue_list, curr_macfile_list):
         #self.write_log('process_multiREAD')
-        files_to_read={}
-        for queue_n in queue_list:
-            files_to_read[str(queue_n)]=[]
-            n_outputs = len(getOutputImageFiles(curr_macfile_list[0]))
-            for j in range(n_outputs):
-                files_to_read[str(queue_n)].append([])
-
-        for i, queue_n in enumerate(queue_list):
-            output_filepaths = getOutputImageFiles(curr_macfile_list[i])
+        files_to_read = []
+        for queue_n, curr_macfile in zip(queue_list, curr_macfile_list):
+            received = self.received.pop(getSimulationParametersFromPath(curr_macfile), None)
+            if received is not None: # the output images have been sent over MPI, there are no files to read
+                for j, (image, dtype) in enumerate(zip(*received)):
+                    self.accumulate(queue_n, j, image, dtype)
+                continue
+            output_filepaths = getOutputImageFiles(curr_macfile)
             for j, output_filepath in enumerate(output_filepaths):
-                files_to_read[str(queue_n)][j].append(output_filepath)
+                files_to_read.append((queue_n, j, output_filepath))
 
-        for i, (queue_n, files) in enumerate(files_to_read.items()):
-            images = []
-            for j in range(n_outputs):
-                self.write_log('multi reading {}'.format(files[j]))
-                reader = stack_images(files[j])
-                images.append(reader.get_stack())
+        if self.readers is None:
+            for queue_n, j, output_filepath in files_to_read:
+                self.log.debug('multi reading %s', output_filepath)
+                for image in read_and_remove(output_filepath): # one file at a time, summed in place
+                    self.accumulate(queue_n, j, image)
+            return
 
-                for file_to_del in files[j]:
-                    os.remove(file_to_del)
-                
-                #nda = itk.GetArrayFromImage(images[-1])
-                #nda = np.sum(images[-1],axis=0)
-                #images[-1] = itk.GetImageFromArray(nda)
-                images[-1] = np.sum(images[-1],axis=0)
-            
-            stored_image = self.images.get(queue_n, None)
-            if stored_image is None:
-                self.images[queue_n] = images
-            else:
-                for i,image in enumerate(images):
-                    self.images[queue_n][i] = image + stored_image[i]
+        # At most 2*n_readers decoded files are held in memory; they are accumulated in submission order, so the 
+        # result does not depend on the order in which the readers finish.
+        in_flight = deque()
+        for i, (queue_n, j, output_filepath) in enumerate(files_to_read):
+            self.log.debug('multi reading %s', output_filepath)
+            in_flight.append((queue_n, j, self.readers.submit(read_and_remove, output_filepath)))
+            if len(in_flight) >= 2*self.n_readers or i == len(files_to_read)-1:
+                while len(in_flight) > (self.n_readers if i < len(files_to_read)-1 else 0):
+                    queue_n, j, future = in_flight.popleft()
+                    for image in future.result():
+                        self.accumulate(queue_n, j, image)
 
+    def close(self):
+        if self.readers is not None:
+            self.readers.shutdown()
+        self.writers.shutdown()
+        for container in self.containers.values():
+            container.close()
+        self.containers = {}
+        close_log(self.log)
 
-    def process_WRITE(self, queue_n, macfile):
+    def has_images(self, queue_n):
+        return str(queue_n) in self.images
+
+    # Hands the accumulated images of the queue slot to the writers and frees the slot. It returns the future of 
+    # the write, which is done once the merged images (and the merged ROOT file, if any) are on disk. The images 
+    # are multiplied by scale, e.g. to make up for the subSims cancelled by the early stopping, and the outputs of the
+    # previous runs (top-up) by base_scale before being added.
+    def process_WRITE(self, queue_n, macfile, scale=1., base_scale=1.):
         #self.write_log('process_WRITE')
-        output_filepaths = getOutputImageFiles(macfile)
-        for i,  output_filepath in enumerate(output_filepaths):
-            ext = output_filepath[output_filepath.rfind('.'):]
-            output_cumfilepath = output_filepath[:output_filepath.rfind('_')] + ext
-            self.write_log('writing {}'.format(output_cumfilepath))
-            #self.writer.SetFileName(output_cumfilepath)
-            #self.writer.Execute(self.images.get(str(queue_n))[i])
-            writer = stack_images(output_cumfilepath, mode='w')
-            writer.write_image(self.images.get(str(queue_n))[i])
-        del self.images[str(queue_n)]
-        
-        output_root_filepath = getOutputRootFile(macfile)
-        if output_root_filepath is not None:
-            ext = '.root'
-            basename = output_root_filepath[:output_root_filepath.rfind('_')]
-            output_cumfilepath = basename + ext
-            # Launch system command to merge root files (hadd)
-            os.system('hadd -f {} {}'.format(output_cumfilepath, basename+'_*'))
-            os.system('rm {}_*'.format(basename))
+        images = self.images.pop(str(queue_n), None)
+        dtypes = self.dtypes.pop(str(queue_n), None)
+        self.noise_stats.pop(str(queue_n), None)
+        if images is None: # all the jobs of the projection failed, there is nothing to write
+            self.log.warning('no output to write for %s', macfile)
+            future = Future()
+            future.set_result(None)
+            return future
+        if scale != 1.:
+            for image in images:
+                image *= scale
+        self.pending_writes.acquire()
+        return self.writers.submit(self.write_merged, images, dtypes, macfile, base_scale)
+
+    # Top-up: the merged output of the previous runs is moved into topup_dir the first time the projection is merged
+    # in this run, so that merging the projection again (e.g. in a resumed run) does not count it twice. It returns 
+    # the path of the moved output, or None if the previous runs have no such output.
+    def get_topup_base(self, output_cumfilepath):
+        base = os.path.join(self.topup_dir, os.path.abspath(output_cumfilepath).lstrip(os.sep))
+        if not os.path.exists(base):
+            if not os.path.exists(output_cumfilepath):
+                return None
+            pathlib.Path(os.path.dirname(base)).mkdir(parents=True, exist_ok=True)
+            shutil.move(output_cumfilepath, base)
+        return base
+
+    # The container of an output out/<proj>/name.ext and the options of its backend: out/name.npy with the npy backend,
+    # the dataset name of out/<jobName>.h5 (which holds all the outputs of the job) with the hdf5 backend
+    def get_container_path(self, output_cumfilepath, macfile):
+        folder = os.path.dirname(os.path.dirname(output_cumfilepath))
+        name = os.path.splitext(os.path.basename(output_cumfilepath))[0]
+        if self.output_backend == 'npy':
+            return os.path.join(folder, name+'.npy'), {}
+        jobName = os.path.basename(macfile).rsplit('_', 2)[0]
+        return os.path.join(folder, jobName+'.h5'), {'dataset': name}
+
+    # Writes the merged image of a projection in its slot of the container. The container is created by the first 
+    # write of a new run, and opened again when resuming. In top-up runs, the container of the previous runs is moved 
+    # aside once and its images, multiplied by base_scale, are added to the new ones.
+    def write_container_image(self, container_path, options, proj, image, dtype, metadata, base_scale=1.):
+        key = (container_path,)+tuple(options.values())
+        with self.container_lock:
+            base = self.get_topup_base(container_path) if self.topup_dir is not None else None
+            if key not in self.containers:
+                self.containers[key] = stack_images(container_path, 'rw', self.output_backend, n_images=self.n_projs, **options)
+            if base is not None and ('base',)+key not in self.containers:
+                self.containers[('base',)+key] = stack_images(base, 'r', self.output_backend, **options)
+            container = self.containers[key]
+        if base is not None:
+            base_stack = self.containers[('base',)+key]
+            image = image+base_scale*base_stack.get_image(proj)
+            if metadata is not None and 'primaries' in metadata: # the primaries of all the runs
+                metadata = dict(metadata, primaries=metadata['primaries']+base_stack.get_metadata(proj).get('primaries', 0))
+        container.write_image(image.astype(dtype), proj, metadata)
+
+    def count_write(self, output_cumfilepath, start, image, dtype):
+        if self.perf is not None:
+            self.perf.span('write', start, time.time(), file=output_cumfilepath)
+            self.perf.count(write_time=time.time()-start, images_written=1, bytes_written=image.size*np.dtype(dtype).itemsize)
+
+    def write_merged(self, images, dtypes, macfile, base_scale=1.):
+        try:
+            output_filepaths = getOutputImageFiles(macfile)
+            for i,  output_filepath in enumerate(output_filepaths):
+                ext = output_filepath[output_filepath.rfind('.'):]
+                output_cumfilepath = output_filepath[:output_filepath.rfind('_')] + ext
+                if self.output_backend != 'itk': # out/<proj>/name.ext goes to the slot proj of a container in out
+                    proj = getSimulationParametersFromPath(macfile)[1]
+                    container_path, options = self.get_container_path(output_cumfilepath, macfile)
+                    self.write_log('writing {} in {}'.format(output_cumfilepath, container_path))
+                    # the metadata of the projection are the same for all its outputs
+                    metadata = self.get_metadata(proj) if self.get_metadata is not None and i == 0 else None
+                    start = time.time()
+                    self.write_container_image(container_path, options, proj, images[i], dtypes[i], metadata, base_scale)
+                    self.count_write(output_cumfilepath, start, images[i], dtypes[i])
+                    continue
+                base = self.get_topup_base(output_cumfilepath) if self.topup_dir is not None else None
+                if base is not None: # merged outputs are sums over the runs, as they are over the subSims
+                    for image in stack_images(base).get_stack():
+                        images[i] += base_scale*image
+                self.write_log('writing {}'.format(output_cumfilepath))
+                start = time.time()
+                writer = stack_images(output_cumfilepath, mode='w')
+                writer.write_image(images[i].astype(dtypes[i]))
+                self.count_write(output_cumfilepath, start, images[i], dtypes[i])
+            
+            output_root_filepath = getOutputRootFile(macfile)
+            if output_root_filepath is not None:
+                ext = '.root'
+                basename = output_root_filepath[:output_root_filepath.rfind('_')]
+                output_cumfilepath = basename + ext
+                base = self.get_topup_base(output_cumfilepath) if self.topup_dir is not None else None
+                # Launch system command to merge root files (hadd)
+                start = time.time()
+                os.system('hadd -f {} {}'.format(output_cumfilepath, (base+' ' if base is not None else '')+basename+'_*'))
+                if self.perf is not None:
+                    self.perf.span('hadd', start, time.time(), file=output_cumfilepath)
+                    self.perf.count(hadd_time=time.time()-start)
+                os.system('rm {}_*'.format(basename))
+        finally:
+            self.pending_writes.release()
             
         # if not self.keep_macfile:
         #     # All output files have been written, delete the macfiles related to that projection
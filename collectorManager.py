@@ -17,13 +17,17 @@
 
 from mpi4py import MPI
 import numpy as np
-from threading import Lock, Thread
-import logging, os, sys, time
+from threading import Lock, Thread, Condition
+from collections import deque, namedtuple
+from functools import partial
+import logging, os, sys, time, threading
 from utils import *
 from collector import collector
+from logger import get_log, close_log, flush_logs
             
 
 sys.excepthook = global_except_hook
+threading.excepthook = global_thread_except_hook
             
 class collectState:
     
@@ -33,13 +37,43 @@ class collectState:
         self.state       = np.zeros((nSubSims,nProjs),dtype=np.int32)
         self.assigned_to = -np.ones((nSubSims,nProjs),dtype=np.int32)
         self.macfile     = [[None]*nProjs for i in range(nSubSims)]
+        self.pending     = deque() # (subSim, proj) pairs not yet handed to a worker (dynamic scheduling only)
+        # Counters and READY jobs, kept up to date by set_state: the queries of the manager threads do not scan the 
+        # state matrix, they cost O(1) (or the number of READY jobs)
+        self.n_in_state = [0]*len(states) # number of jobs per state
+        self.n_in_state[states.SLEEPING.value] = nSubSims*nProjs
+        self.n_done = [0]*nProjs # number of DONE jobs per projection
+        self.ready  = {} # (subSim, proj) -> None, the READY jobs in the order they got READY
+        self.avoid  = {} # (subSim, proj) -> rank on which the job failed, for the jobs queued again
+        self.cancelled = set() # (subSim, proj) cancelled by the early stopping
+        # Early stopping: the subSims of a projection from n_pilot on are held back until the noise of the first ones
+        # has been checked (see hold_back)
+        self.n_pilot = None
+        self.held = {} # proj -> deque of the subSims held back, in projection order
+        self.released = deque() # (subSim, proj) released by their projection, handed out first
         self.mutex = Lock()
-        self.log = open(os.path.join(logFolder,"state.log"), "w") 
+        self.log = get_log('state', os.path.join(logFolder,"state.log"))
         self.write_log("init")
 
-    def write_log(self, message):
-        self.log.write(getTimeString()+': ' +message+'\n')
-        self.log.flush()
+    def write_log(self, message, *args):
+        self.log.info(message, *args)
+
+    # Sets the state of a job and updates the counters. The mutex must be held.
+    def set_state(self, subSim, proj, new_value):
+        old_value = int(self.state[subSim,proj])
+        if old_value == new_value:
+            return
+        self.state[subSim,proj] = new_value
+        self.n_in_state[old_value] -= 1
+        self.n_in_state[new_value] += 1
+        if old_value == states.DONE.value:
+            self.n_done[proj] -= 1
+        elif new_value == states.DONE.value:
+            self.n_done[proj] += 1
+        if old_value == states.READY.value:
+            del self.ready[(int(subSim), int(proj))]
+        elif new_value == states.READY.value:
+            self.ready[(int(subSim), int(proj))] = None
 
     def assign(self, macfile,rank, subSim, proj):
         proj   = proj
@@ -47,18 +81,134 @@ class collectState:
         self.assigned_to[subSim,proj] = rank 
         self.macfile[subSim][proj]     = macfile 
 
+    def add_pending(self, subSim, proj):
+        if self.n_pilot is not None and subSim >= self.n_pilot:
+            self.held.setdefault(proj, deque()).append(subSim)
+        else:
+            self.pending.append((subSim, proj))
+
+    # Early stopping: only the first n_pilot subSims of every projection are queued, the others are held back until 
+    # the projection is released (its noise has been checked, and more subSims are needed) or cancelled. Otherwise, 
+    # as the jobs are handed out in projection order, all of them would be running by the time the noise is known.
+    def hold_back(self, n_pilot):
+        self.mutex.acquire()
+        self.n_pilot = n_pilot
+        pending, self.pending = self.pending, deque()
+        for subSim, proj in pending:
+            self.add_pending(subSim, proj)
+        self.mutex.release()
+
+    def release(self, proj):
+        self.mutex.acquire()
+        held = self.held.pop(proj, ())
+        self.released.extend((subSim, proj) for subSim in held)
+        if len(held) > 0:
+            self.log.debug("projection %d: %d held back jobs released", proj, len(held))
+        self.mutex.release()
+
+    # The next job to hand out: the released ones first, as their projection is already in the queue of the manager,
+    # then the queued ones and, rather than leaving a worker idle, the ones held back
+    def pop_pending(self):
+        if len(self.released) > 0:
+            return self.released.popleft()
+        if len(self.pending) > 0:
+            return self.pending.popleft()
+        if len(self.held) > 0:
+            proj = next(iter(self.held))
+            subSim = self.held[proj].popleft()
+            if len(self.held[proj]) == 0:
+                del self.held[proj]
+            return subSim, proj
+        return None
+
+    # Pops the next job of the pending queue and assigns it to the given rank. Returns None if the queue is empty.
+    # Jobs which are already DONE (skipped by the adaptive splitting, or cancelled) are dropped. A job which failed on 
+    # the rank is left to the other ranks, unless there is nothing else to do.
+    def next_pending(self, rank):
+        self.mutex.acquire()
+        return_value = None
+        avoided = None
+        while True:
+            job = self.pop_pending()
+            if job is None:
+                break
+            subSim, proj = job
+            if self.state[subSim,proj] == states.DONE.value:
+                continue
+            if avoided is None and self.avoid.get((subSim, proj)) == rank:
+                avoided = (subSim, proj)
+                continue
+            return_value = (subSim, proj)
+            break
+        if avoided is not None:
+            if return_value is None:
+                return_value = avoided
+            else:
+                self.pending.appendleft(avoided)
+        if return_value is not None:
+            self.assigned_to[return_value] = rank
+        self.mutex.release()
+        return return_value
+
+    # A job which failed is queued again, in front of the others, to be run by another rank if possible
+    def requeue(self, subSim, proj, failed_rank):
+        self.mutex.acquire()
+        self.assigned_to[subSim,proj] = -1
+        self.avoid[(subSim, proj)] = failed_rank
+        self.pending.appendleft((subSim, proj))
+        self.write_log("job ("+str(subSim)+","+str(proj)+") failed on rank "+str(failed_rank)+", queued again")
+        self.mutex.release()
+
+    # Adaptive splitting: the projection is split into n_splits jobs only, the other subSims are marked as DONE
+    def skip(self, proj, n_splits):
+        self.mutex.acquire()
+        for subSim in range(n_splits, self.nSubSims):
+            self.set_state(subSim, proj, states.DONE.value)
+        self.write_log("projection "+str(proj)+" split into "+str(n_splits)+" jobs")
+        self.mutex.release()
+
+    # Marks as DONE the jobs which have been completed by a previous run (see read_checkpoint)
+    def restore(self, done):
+        self.mutex.acquire()
+        for subSim, proj in np.argwhere(done):
+            self.set_state(subSim, proj, states.DONE.value)
+        self.write_log("restored "+str(np.sum(done))+" DONE jobs from checkpoint")
+        self.mutex.release()
+
+    # Early stopping: the jobs of the projection which have not been handed out yet are marked as DONE. It returns 
+    # the number of cancelled jobs.
+    def cancel(self, proj):
+        self.mutex.acquire()
+        cancelled = (self.state[:,proj] == states.SLEEPING.value) & (self.assigned_to[:,proj] == -1)
+        for subSim in np.flatnonzero(cancelled):
+            self.set_state(subSim, proj, states.DONE.value)
+            self.cancelled.add((int(subSim), proj))
+        self.held.pop(proj, None)
+        if np.any(cancelled):
+            self.write_log("projection "+str(proj)+": "+str(np.sum(cancelled))+" jobs cancelled")
+        else:
+            self.log.debug("projection %d: no job to cancel", proj)
+        self.mutex.release()
+        return int(np.sum(cancelled))
+
+    def get_state(self):
+        self.mutex.acquire()
+        return_value = self.state.copy()
+        self.mutex.release()
+        return return_value
+
     def changeState(self,subSim,proj, new_state):
         proj   = proj
         subSim = subSim
         self.mutex.acquire()
-        self.log.write(getTimeString()+": ("+str(subSim)+","+str(proj)+") "+states(self.state[subSim,proj]).name+" to "+new_state.name+'\n')
-        self.log.flush()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("(%d,%d) %s to %s", subSim, proj, states(self.state[subSim,proj]).name, new_state.name)
         if new_state.value - self.state[subSim,proj] == 1:
-            self.state[subSim,proj] = new_state.value
+            self.set_state(subSim, proj, new_state.value)
         elif (new_state == states.DONE) and (self.state[subSim,proj] == states.READING.value):
-            self.state[subSim,proj] = new_state.value
+            self.set_state(subSim, proj, new_state.value)
         elif (new_state == states.DONE) and (self.state[subSim,proj] == states.READY.value):
-            self.state[subSim,proj] = new_state.value
+            self.set_state(subSim, proj, new_state.value)
         else:
             self.mutex.release()
             raise Exception("collectState has been requested to perform an invalid changeState(): proj "+str(subSim)+" subSim "+str(proj)+" change "+states(self.state[subSim,proj]).name+" to "+new_state.name)
@@ -66,7 +216,7 @@ class collectState:
 
     def get_READY_processes(self):
         self.mutex.acquire()
-        return_value = np.argwhere(self.state==states.READY.value)
+        return_value = list(self.ready)
         self.mutex.release()
         return return_value
 
@@ -74,44 +224,82 @@ class collectState:
         proj   = proj
         subSim = subSim
         self.mutex.acquire()
-        return_value=False
-        done_jobs = (self.state[:,proj]==states.DONE.value) 
-        if np.sum(done_jobs) == len(done_jobs)-1:
-            i, = np.where(done_jobs == False)
-            i = i[0]
-            return_value = True if (i==subSim and self.state[i,proj]>=states.READING.value) else False
+        # the job is the last one of the projection which is not DONE, and it has been read
+        return_value = self.n_done[proj] == self.nSubSims-1 and states.READING.value <= self.state[subSim,proj] < states.DONE.value
 
         if return_value: # debug
-            self.write_log('Could write! ('+str(subSim)+','+str(proj)+')')
+            self.log.debug('Could write! (%d,%d)', subSim, proj)
         self.mutex.release()
         return return_value
 
     def thereAreStillSleepingProcesses(self):
         self.mutex.acquire()
-        return_value = np.any(self.state==states.SLEEPING.value)
+        return_value = self.n_in_state[states.SLEEPING.value] > 0
         self.mutex.release()
         return return_value
 
     def thereIsStillWorkForManager(self):
         self.mutex.acquire()
-        return_value = np.any(self.state!=states.DONE.value)
+        return_value = self.n_in_state[states.DONE.value] < self.nSubSims*self.nProjs
         self.mutex.release()
         return return_value
 
     def isWorkerBusy(self):
         self.mutex.acquire()
-        return_value = np.any( (self.state==states.READING.value) | (self.state==states.WRITING.value))
+        return_value = self.n_in_state[states.READING.value]+self.n_in_state[states.WRITING.value] > 0
         self.mutex.release()
         return return_value
 
+# Reads a checkpoint written by collectorManager.save_checkpoint. It returns the (subSim, proj) matrix of the jobs 
+# which do not have to be executed again, the partial sums of the projections which are not complete yet, as
+# proj -> (images, dtypes), and the primaries of the merged projections, as proj -> (nominal, simulated).
+def read_checkpoint(checkpoint_path, template_hash):
+    with np.load(checkpoint_path) as checkpoint:
+        if str(checkpoint['hash']) != template_hash:
+            raise Exception('The checkpoint '+checkpoint_path+' has been written for a different macfile, it cannot be resumed')
+        done = checkpoint['done']
+        partial = {}
+        for proj in checkpoint['partial_projs'].tolist():
+            n_images = int(checkpoint['n_images_'+str(proj)])
+            images = [checkpoint['image_{}_{}'.format(proj, j)] for j in range(n_images)]
+            dtypes = [np.dtype(str(checkpoint['dtype_{}_{}'.format(proj, j)])) for j in range(n_images)]
+            partial[proj] = (images, dtypes)
+        merged = {}
+        if 'merged_projs' in checkpoint: # older checkpoints
+            merged = {proj: tuple(primaries) for proj, primaries in zip(checkpoint['merged_projs'].tolist(), checkpoint['merged_primaries'].tolist())}
+    return done, partial, merged
+
+# Adaptive splitting: the default, minimum and maximum number of jobs of a projection
+adaptive_splits = namedtuple('adaptive_splits', ['default', 'min', 'max'])
+# Early stopping: the relative noise target, the minimum number of subSims and the region of interest (x0, x1, y0, y1)
+noise_stopping = namedtuple('noise_stopping', ['target', 'min_subsims', 'roi'])
+
 class collectorManager:
 
-    def __init__(self, logFolder, cstate, queue_size, keep_macfile=False):
-        self.sleep_time_done_nothing = int(10)
-        self.sleep_time_done_something = int(5)
+    def __init__(self, logFolder, cstate, queue_size, *, keep_macfile=False, scheduler='static', is_test=False, transfer='file', reduction='collector', n_readers=1, n_writers=1, 
+                 checkpoint_path=None, checkpoint_hash=None, checkpoint_interval=60, partial=None, adaptive=None, topup_dir=None, noise=None, output_backend='itk', get_metadata=None, perf=None, messages=None,
+                 max_retries=0, failed_projections='rescale', job_primaries=None, base_primaries=None, merged=None):
+        self.max_wait_time = int(10) # upper bound to the wait for a DONE signal, the operator is normally woken up by comm_listener
         self.comm = MPI.COMM_WORLD
+        self.messages = messages # messenger shared with the workers, signals are polled without blocking
+        # while there is nothing to receive, the wait between two polls doubles from min to max poll interval
+        self.min_poll_interval, self.max_poll_interval = 1e-4, 5e-2
+        self.receiving = [] # (requests, images, callback) of the images being received, see receive_images
         self.keep_macfile = keep_macfile
-        self.collector = collector(logFolder)
+        self.scheduler = scheduler
+        self.transfer = transfer
+        self.reduction = reduction
+        self.n_closed_workers = 0
+        # Early stopping (dynamic scheduler only), see noise_stopping
+        self.noise = noise
+        if noise is not None:
+            cstate.hold_back(noise.min_subsims)
+        self.stopped = {} # proj -> number of jobs which have not been cancelled
+        self.collector = collector(logFolder, n_readers=n_readers, n_writers=n_writers, topup_dir=topup_dir, 
+                                   noise_roi=noise.roi if noise is not None else None, output_backend=output_backend, 
+                                   n_projs=cstate.nProjs, get_metadata=get_metadata, perf=perf)
+        self.perf = perf # perf_recorder: the timings of the jobs follow their DONE signals
+        self.write_error = None
         self.rank = self.comm.Get_rank()
         self.size = self.comm.Get_size()
         self.queue_size = queue_size
@@ -119,10 +307,49 @@ class collectorManager:
         if self.rank != 0:
             raise Exception(getTimeString()+": It should work on rank 0 instead of rank "+str(self.rank))
         self.shall_listen_comm = True
-        self.log = open(os.path.join(logFolder, "manager.log"), "w") 
-        self.log.write("init\n")
+        self.log = get_log('manager', os.path.join(logFolder, "manager.log"))
+        self.write_log("init")
         self.mutex = Lock()
+        self.event = Condition()
+        self.n_events = 0
+        self.is_test = is_test
+        self.done_times  = {} # (subSim, proj) -> time at which DONE was received, only used for the benchmark in test mode
+        self.write_times = {} # proj -> time at which the merged projection has been written
         self.queue_n = [-1 for i in range(self.queue_size)]
+        # The checkpoint is written after each merged projection and, if some job has been read in the meantime,
+        # every checkpoint_interval seconds. The partial sums of a resumed run get back their queue slot.
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_hash = checkpoint_hash
+        self.checkpoint_interval = checkpoint_interval
+        self.n_written = 0
+        self.checkpointed = (0, 0) # (n_written, n_events) at the time of the last checkpoint
+        self.last_checkpoint_time = time.time()
+        for proj, (images, dtypes) in (partial or {}).items():
+            queue_n = self.queue_n.index(-1)
+            self.queue_n[queue_n] = proj
+            self.collector.images[str(queue_n)] = images
+            self.collector.dtypes[str(queue_n)] = dtypes
+        # Adaptive splitting (dynamic scheduler only), see adaptive_splits. The cost
+        # of a projection is measured as the runtime of its jobs (from WORK to DONE) times their number.
+        self.adaptive = adaptive
+        self.splits = {} # proj -> number of jobs
+        self.dispatch_times = {} # (subSim, proj) -> time at which the job has been handed out
+        self.proj_costs = {} # proj -> list of the estimates of its cost, one per job
+        # Failed jobs (FAILED signal): with the dynamic scheduler, they are handed out again (to another rank, if 
+        # possible) up to max_retries times; the static workers retry on their own. The jobs which failed for good 
+        # do not contribute to their projection, which is then rescaled to the primaries of all its jobs (weighted
+        # by job_primaries(proj, subSim, n_splits), if given) with failed_projections='rescale', or written as it is 
+        # with 'flag'. In both cases they are recorded in the run manifest.
+        self.max_retries = max_retries
+        self.failed_projections = failed_projections
+        self.job_primaries = job_primaries
+        self.failed_runs = {} # (subSim, proj) -> number of failed runs of the job
+        self.failed = {} # proj -> {subSim: (rank, return code, number of runs)} for the jobs which failed for good
+        self.recovered = set() # (subSim, proj) of the jobs which failed and then succeeded (their DONE came)
+        # Top-up: (nominal, simulated) primaries per projection of the outputs of the previous runs, see get_scales.
+        # The primaries of the projections merged before the run was interrupted come back from the checkpoint.
+        self.base_primaries = base_primaries
+        self.merged_primaries = dict(merged or {}) # proj -> (nominal, simulated) primaries of its merged output
         self.threadList = []
         self.threadList.append(Thread(target=self.comm_listener, daemon=True))
         self.has_intercomm_ended = False
@@ -130,23 +357,169 @@ class collectorManager:
         for thread in self.threadList:
             thread.start()
 
+    def isListening(self):
+        if self.scheduler == 'dynamic': # every worker has to be told that there is no more work
+            return self.n_closed_workers < self.size-1
+        return self.cs.thereAreStillSleepingProcesses()
+
+    # The images which follow a DONE (or REDUCED) message are received in the background: callback(images) is called
+    # by comm_listener once they have all arrived, meanwhile the other messages are handled
+    def receive_images(self, rank, record, callback):
+        requests, images = self.messages.recv_images(rank, record)
+        self.receiving.append((requests, images, callback))
+
+    # Calls the callbacks of the images received, returns whether there were any
+    def complete_receives(self):
+        completed, receiving = [], []
+        for entry in self.receiving:
+            (completed if MPI.Request.Testall(entry[0]) else receiving).append(entry)
+        self.receiving = receiving
+        for requests, images, callback in completed:
+            callback(images)
+        return len(completed) > 0
+
+    # A job is READY once its outputs are available: on the filesystem, or in memory when they have been received
+    def job_ready(self, subSim, proj, images=None):
+        if images is not None:
+            self.collector.store_images(subSim, proj, images)
+        self.cs.changeState(subSim, proj, states.READY)
+        self.notify_operator()
+
+    # The subSims of a projection reduced by a group leader (tree reduction) are READY at once
+    def reduced_ready(self, proj, nSubSims, dtypes, images):
+        self.collector.store_images(0, proj, images, dtypes)
+        for s in range(nSubSims):
+            self.collector.store_images(s, proj, []) if s > 0 else None
+            self.cs.changeState(s, proj, states.READY)
+        self.notify_operator()
+
     def comm_listener(self):
-        while self.cs.thereAreStillSleepingProcesses():
-            self.write_log("probing for message")
-            data = np.zeros((1,4), dtype=np.int32)
-            self.comm.Recv([data,MPI.INT], source=MPI.ANY_SOURCE)
-            data = data.tolist()[0]
-            signal, rank, subSim, proj  = [int(item) for item in data[0:4]]
-            self.write_log("received "+signals(signal).name +" from rank "+str(rank))
+        poll_interval = self.min_poll_interval
+        while self.isListening() or len(self.receiving) > 0:
+            received = self.complete_receives()
+            message = self.messages.poll()
+            if message is None:
+                if not received:
+                    time.sleep(poll_interval)
+                    poll_interval = min(2*poll_interval, self.max_poll_interval)
+                continue
+            poll_interval = self.min_poll_interval
+            signal, rank, record = message
+            subSim, proj = int(record['subSim']), int(record['proj'])
+            self.log.debug("received %s from rank %d", signal.name, rank)
             
-            if signal == signals.DONE.value:
-                self.cs.changeState(subSim, proj, states.READY)
+            if signal == signals.DONE:
+                self.done_times[(subSim, proj)] = time.time()
+                if (subSim, proj) in self.failed_runs:
+                    self.recovered.add((subSim, proj))
+                if self.perf is not None:
+                    self.perf.add_job(subSim, proj, rank, record['timing'], self.done_times[(subSim, proj)])
+                if self.transfer == 'mpi': # the output images follow the DONE signal
+                    self.receive_images(rank, record, partial(self.job_ready, subSim, proj))
+                else:
+                    self.job_ready(subSim, proj)
+                if self.adaptive is not None:
+                    runtime = time.time()-self.dispatch_times.pop((subSim, proj))
+                    self.proj_costs.setdefault(proj, []).append(runtime*self.splits[proj])
+                if self.scheduler == 'dynamic':
+                    self.send_next_job(rank)
+            elif (signal == signals.REDUCED) and (self.reduction == 'tree'):
+                # the images of all the n_subsims subSims of the projection have already been summed by the group 
+                # leader: they are stored as the output of subSim 0, the others do not contribute anything
+                nSubSims = int(record['n_subsims'])
+                if self.perf is not None: # the timings of the leader, for subSim 0
+                    self.perf.add_job(0, proj, rank, record['timing'], time.time())
+                for s in range(nSubSims):
+                    self.done_times[(s, proj)] = time.time()
+                    self.recovered.add((s, proj)) if (s, proj) in self.failed_runs and s not in self.failed.get(proj, {}) else None
+                out_dtypes = [image_dtypes[code] for code in record['out_dtype'][:record['n_images']]]
+                self.receive_images(rank, record, partial(self.reduced_ready, proj, nSubSims, out_dtypes))
+            elif (signal == signals.REQUEST) and (self.scheduler == 'dynamic'):
+                self.send_next_job(rank)
+            elif signal == signals.FAILED:
+                self.job_failed(subSim, proj, int(record['rank']), record)
+            elif signal == signals.ERROR:
+                text = record['text'].decode(errors='replace')
+                self.log.error("rank %d failed on job (%d,%d):\n%s", rank, subSim, proj, text)
+                flush_logs(timeout=5) # the worker aborts the run once it gets the ACK
+                self.messages.send(signals.ACK, rank, subSim=subSim, proj=proj)
+                self.messages.flush(timeout=1)
+                raise Exception(getTimeString()+": rank "+str(rank)+" failed on job ("+str(subSim)+","+str(proj)+"):\n"+text)
             else:
-                raise Exception(getTimeString()+": Received unknown signal from slave "+str(rank))
+                raise Exception(getTimeString()+": Received unknown signal "+signal.name+" from slave "+str(rank))
+        self.messages.flush()
         self.write_log("comm_listener terminated")
 
+    # A job failed on the rank: it is queued again, unless it has been run max_retries+1 times (or the worker has
+    # already retried it, with the static scheduler), in which case the projection is completed without it. With 
+    # the tree reduction, the job becomes READY with the other subSims of its projection, when they are reduced.
+    def job_failed(self, subSim, proj, rank, record):
+        attempt, rc = int(record['attempt']), int(record['rc'])
+        self.failed_runs[(subSim, proj)] = attempt+1
+        self.dispatch_times.pop((subSim, proj), None)
+        self.log.warning("job (%d,%d) failed on rank %d, attempt %d, return code %d:\n%s", subSim, proj, rank, attempt, rc, 
+                         record['text'].decode(errors='replace'))
+        if not record['final']:
+            return
+        if self.scheduler == 'dynamic' and attempt < self.max_retries:
+            self.cs.requeue(subSim, proj, rank)
+        else:
+            self.failed.setdefault(proj, {})[subSim] = (rank, rc, attempt+1)
+            self.log.warning("job (%d,%d) given up after %d attempts", subSim, proj, attempt+1)
+            if self.reduction == 'tree': # its zeros are in the REDUCED images, which follow
+                return
+            self.collector.store_images(subSim, proj, []) # nothing to read
+            self.cs.changeState(subSim, proj, states.READY)
+            self.notify_operator()
+        if self.scheduler == 'dynamic':
+            self.send_next_job(rank)
+
+    # The WORK signal carries the number of jobs the projection has been split into and the attempt
+    def send_next_job(self, rank):
+        job = self.cs.next_pending(rank)
+        if job is None:
+            self.messages.send(signals.CLOSE, rank, subSim=-1, proj=-1)
+            self.n_closed_workers += 1
+            self.write_log("sending CLOSE to rank "+str(rank))
+        else:
+            subSim, proj = job
+            if self.adaptive is not None:
+                if proj not in self.splits: # first job of the projection
+                    self.splits[proj] = self.choose_split(proj)
+                    self.cs.skip(proj, self.splits[proj])
+                self.dispatch_times[(subSim, proj)] = time.time()
+            self.messages.send(signals.WORK, rank, subSim=subSim, proj=proj, n_splits=self.splits.get(proj, self.cs.nSubSims), 
+                               attempt=self.failed_runs.get((subSim, proj), 0))
+            self.log.debug("sending job (%d,%d) to rank %d", subSim, proj, rank)
+
+    # Chooses the number of jobs of a projection when its first job is handed out. The cost of each projection left 
+    # is taken from the closest projection already measured, and the jobs are sized so that the work left would be 
+    # spread over two jobs per worker (guided self-scheduling): large jobs at first, smaller ones at the end of the
+    # scan, when they fill the idle workers. Projections are handed out in order, so those left follow proj.
+    def choose_split(self, proj):
+        default_splits, min_splits, max_splits = self.adaptive.default, self.adaptive.min, self.adaptive.max
+        if len(self.proj_costs) == 0:
+            return default_splits
+        measured = np.array(list(self.proj_costs.keys()))
+        costs = np.array([np.mean(self.proj_costs[p]) for p in measured])
+        projs_left = np.arange(proj, self.cs.nProjs)
+        costs_left = costs[np.abs(projs_left[:,np.newaxis]-measured[np.newaxis,:]).argmin(axis=1)]
+        job_cost = np.sum(costs_left)/(2*(self.size-1))
+        n_splits = int(np.ceil(costs_left[0]/job_cost))
+        return min(max(n_splits, min_splits), max_splits)
+
+    # Wakes up intercomm_operator, if it is waiting for new READY jobs
+    def notify_operator(self):
+        with self.event:
+            self.n_events += 1
+            self.event.notify()
+
     def intercomm_operator(self):
         while self.cs.thereIsStillWorkForManager():
+            with self.event:
+                handled_events = self.n_events
+            if self.write_error is not None:
+                raise self.write_error
             list_ready_sims = self.cs.get_READY_processes()
             done_something = False
             for subSim, proj in list_ready_sims:
@@ -156,61 +529,207 @@ class collectorManager:
                 
             to_be_processed_projs = [value for value in list_ready_sims if value[1] in self.queue_n]
             if len(to_be_processed_projs) > 0:
-                self.write_log("processing jobs {}: next in queue".format(to_be_processed_projs))
+                self.log.debug("processing jobs %s: next in queue", to_be_processed_projs)
                 self.multi_process(to_be_processed_projs)
                 done_something = True
 
-            time.sleep(self.sleep_time_done_nothing) if not done_something else time.sleep(self.sleep_time_done_something)
+            if self.checkpoint_path is not None:
+                self.update_checkpoint()
+
+            if not done_something: # sleep until a new DONE arrives, events received during the scan are not lost
+                start = time.time()
+                with self.event:
+                    self.event.wait_for(lambda: self.n_events != handled_events, timeout=self.max_wait_time)
+                if self.perf is not None:
+                    self.perf.count(operator_idle=time.time()-start)
+        if self.checkpoint_path is not None:
+            self.save_checkpoint()
         self.write_log("intercomm_operator terminated")
         self.has_intercomm_ended = True
+        if self.is_test:
+            self.report_latency()
+
+    def update_checkpoint(self):
+        n_written, n_events = self.n_written, self.n_events
+        if n_written != self.checkpointed[0] or (n_events != self.checkpointed[1] and time.time()-self.last_checkpoint_time > self.checkpoint_interval):
+            self.save_checkpoint()
+            self.checkpointed = (n_written, n_events)
+            self.last_checkpoint_time = time.time()
+
+    # Saves the jobs whose outputs are already accounted for, either in a merged projection on disk or in the partial
+    # sums of the queue, together with those partial sums. It runs on the operator thread between two reads, so the 
+    # partial sums match the states. The other jobs (also those of the projections being written) are run again. 
+    def save_checkpoint(self):
+        state = self.cs.get_state()
+        done = np.all(state == states.DONE.value, axis=0)[np.newaxis,:].repeat(state.shape[0], axis=0)
+        partial_projs = []
+        arrays = {}
+        for queue_n, proj in enumerate(self.queue_n):
+            if proj == -1 or str(queue_n) not in self.collector.images:
+                continue
+            partial_projs.append(proj)
+            done[:,proj] = state[:,proj] == states.DONE.value
+            for subSim in self.failed.get(proj, {}): # run again when resuming
+                done[subSim,proj] = False
+            images = self.collector.images[str(queue_n)]
+            dtypes = self.collector.dtypes[str(queue_n)]
+            arrays['n_images_'+str(proj)] = np.array(len(images))
+            for j, (image, dtype) in enumerate(zip(images, dtypes)):
+                arrays['image_{}_{}'.format(proj, j)] = image
+                arrays['dtype_{}_{}'.format(proj, j)] = np.array(dtype.str)
+        # written aside and renamed, so that a run killed while saving leaves the previous checkpoint intact
+        with open(self.checkpoint_path+'.part', 'wb') as f:
+            merged_projs = sorted(self.merged_primaries)
+            np.savez(f, done=done, hash=np.array(self.checkpoint_hash), partial_projs=np.array(partial_projs, dtype=np.int64), 
+                     merged_projs=np.array(merged_projs, dtype=np.int64), 
+                     merged_primaries=np.array([self.merged_primaries[proj] for proj in merged_projs], dtype=np.float64).reshape(-1, 2), **arrays)
+        os.replace(self.checkpoint_path+'.part', self.checkpoint_path)
+        self.write_log("checkpoint saved: {} jobs done, {} partial projections".format(np.sum(done), len(partial_projs)))
+
+    # Benchmark (test mode only): time between the DONE of each job and the write of the merged projection
+    def report_latency(self):
+        latencies = [self.write_times[proj]-t for (subSim, proj), t in self.done_times.items() if proj in self.write_times]
+        last_done = {}
+        for (subSim, proj), t in self.done_times.items():
+            last_done[proj] = max(t, last_done.get(proj, t))
+        last_latencies = [self.write_times[proj]-t for proj, t in last_done.items() if proj in self.write_times]
+        if len(latencies) == 0:
+            return
+        message = "DONE-to-write latency over {} jobs: mean {:.3f} s, max {:.3f} s; last DONE-to-write over {} projections: mean {:.3f} s, max {:.3f} s".format(
+            len(latencies), np.mean(latencies), np.max(latencies), len(last_latencies), np.mean(last_latencies), np.max(last_latencies))
+        self.write_log(message)
+        print(message)
         
-    def write_log(self, message):
-        self.log.write(getTimeString()+': ' +message+'\n')
-        self.log.flush()
+    def write_log(self, message, *args):
+        self.log.info(message, *args)
                 
-    def process(self, subSim, proj):
-        self.write_log("processing job ("+str(subSim)+","+str(proj)+"): sending READ")
-        curr_macfile = self.cs.macfile[subSim][proj]
-        self.cs.changeState(subSim, proj, states.READING)
-        self.collector.process_READ(self.queue_n.index(proj), curr_macfile)
-        self.write_log("job ("+str(subSim)+","+str(proj)+"): received DONE reading")
-
-        if self.cs.shouldWrite(subSim, proj): 
-            #self.write_log("processing job ("+str(subSim)+","+str(proj)+"): sending WRITE")
-            self.cs.changeState(subSim, proj, states.WRITING)
-            self.collector.process_WRITE(self.queue_n.index(proj), curr_macfile)
-            #self.write_log(": job ("+str(subSim)+","+str(proj)+"): received DONE writing")
-            self.queue_n[self.queue_n.index(proj)] = -1
-        self.cs.changeState(subSim, proj, states.DONE)
-        if not self.keep_macfile:
-            os.remove(curr_macfile)
-
     def multi_process(self, to_be_processed_projs):
         jobs = np.array(to_be_processed_projs)
         subsims = jobs[:,0]
         projs   = jobs[:,1]
         curr_macfile_list = []
         queue_list = []
-        self.write_log("processing job(s) {}: sending READ".format(to_be_processed_projs))
+        self.log.debug("processing job(s) %s: sending READ", to_be_processed_projs)
+        start = time.time()
         for subSim,proj in zip(subsims, projs):
             self.cs.changeState(subSim, proj, states.READING)
             curr_macfile_list.append(self.cs.macfile[subSim][proj])
             queue_list.append(self.queue_n.index(proj))
         self.collector.process_multiREAD(queue_list, curr_macfile_list)
-        self.write_log("processing job(s) {}: received DONE reading".format(to_be_processed_projs))
+        if self.perf is not None:
+            for subSim, proj in zip(subsims, projs):
+                self.perf.job_read(int(subSim), int(proj), start)
+            self.perf.span('read', start, time.time(), jobs=len(subsims))
+            self.perf.count(read_time=time.time()-start)
+        self.log.debug("processing job(s) %s: received DONE reading", to_be_processed_projs)
+        if self.noise is not None: # the cancelled jobs have to be DONE before checking which projections to write
+            for proj, queue_n in dict(zip(projs, queue_list)).items():
+                self.check_noise(proj, queue_n)
 
         for i,(subSim,proj) in enumerate(zip(subsims, projs)):
             if self.cs.shouldWrite(subSim, proj): 
-                self.write_log("processing job ("+str(subSim)+","+str(proj)+"): sending WRITE")
+                self.log.debug("processing job (%d,%d): sending WRITE", subSim, proj)
                 self.cs.changeState(subSim, proj, states.WRITING)
-                self.collector.process_WRITE(queue_list[i], curr_macfile_list[i])
-                self.write_log(": job ("+str(subSim)+","+str(proj)+"): received DONE writing")
+                scale, base_scale = self.get_scales(proj, self.collector.has_images(queue_list[i]))
+                future = self.collector.process_WRITE(queue_list[i], curr_macfile_list[i], scale, base_scale)
                 self.queue_n[self.queue_n.index(proj)] = -1
+                # the job reaches DONE only when the merged projection has been written
+                future.add_done_callback(partial(self.write_done, subSim, proj, curr_macfile_list[i]))
+                continue
             self.cs.changeState(subSim, proj, states.DONE)
             if not self.keep_macfile:
                 os.remove(curr_macfile_list[i])
+
+    # Returns the nominal primaries of the projection in this run (those of all its jobs, weighted by 
+    # job_primaries(proj, subSim, n_splits) if given, else counted in jobs) and the simulated ones, i.e. without the 
+    # jobs cancelled by the early stopping and (with failed_projections='rescale') those which have failed
+    def get_primaries(self, proj):
+        failed = self.failed.get(proj, {})
+        n_splits = self.splits.get(proj, self.cs.nSubSims)
+        nominal, simulated = 0., 0.
+        for subSim in range(n_splits):
+            primaries = self.job_primaries(proj, subSim, n_splits) if self.job_primaries is not None else None
+            primaries = 1. if primaries is None else float(primaries)
+            nominal += primaries
+            if (subSim, proj) not in self.cs.cancelled and (subSim not in failed or self.failed_projections != 'rescale'):
+                simulated += primaries
+        return nominal, simulated
+
+    # The merged output is normalised to the nominal primaries of all the runs: the sum of the jobs of this run is 
+    # multiplied by scale and, in top-up runs, the output of the previous runs (normalised to their own nominal 
+    # primaries) by base_scale, which first brings it back to the primaries they have simulated. It returns 
+    # (scale, base_scale) and records the primaries of the merged output.
+    def get_scales(self, proj, has_images):
+        failed = self.failed.get(proj, {})
+        if len(failed) > 0:
+            self.write_log("projection {}: {} failed jobs ({})".format(proj, len(failed), self.failed_projections))
+        base_nominal, base_simulated = (self.base_primaries[0][proj], self.base_primaries[1][proj]) if self.base_primaries is not None else (0., 0.)
+        nominal, simulated = self.get_primaries(proj)
+        if not has_images: # nothing is written, the output of the previous runs (if any) stays as it is
+            self.merged_primaries[proj] = (base_nominal, base_simulated)
+            return 1., 1.
+        nominal, simulated = nominal+base_nominal, simulated+base_simulated
+        self.merged_primaries[proj] = (nominal, simulated)
+        scale = nominal/simulated if simulated > 0 else 1.
+        base_scale = scale*base_simulated/base_nominal if base_nominal > 0 else 1.
+        return scale, base_scale
+
+    # Returns the nominal and the simulated primaries of the merged output of every projection (see get_scales), 
+    # zero for the projections which have never been written
+    def get_projection_primaries(self):
+        nominal, simulated = np.zeros(self.cs.nProjs), np.zeros(self.cs.nProjs)
+        if self.base_primaries is not None:
+            nominal[:], simulated[:] = self.base_primaries
+        for proj, (n, s) in self.merged_primaries.items():
+            nominal[proj], simulated[proj] = n, s
+        return nominal, simulated
+
+    # Returns the jobs which failed for good, with the rank, the return code and the number of runs of their last 
+    # attempt, and the number of jobs which succeeded after failing (not those cancelled in the meantime)
+    def get_failures(self):
+        failures = [{'proj': proj, 'subSim': subSim, 'rank': rank, 'rc': rc, 'attempts': attempts} 
+                    for proj, jobs in sorted(self.failed.items()) for subSim, (rank, rc, attempts) in sorted(jobs.items())]
+        return failures, len(self.recovered)
+
+    # Early stopping: once the relative noise of the subSims read for the projection reaches the target, its jobs 
+    # which have not been handed out yet are cancelled. The merged output is rescaled to nProcesses subSims.
+    def check_noise(self, proj, queue_n):
+        target, min_subsims = self.noise.target, self.noise.min_subsims
+        if proj in self.stopped:
+            return
+        n, noise = self.collector.get_relative_noise(queue_n)
+        if n < min_subsims or noise is None:
+            return
+        if noise > target: # the subSims held back are needed
+            self.cs.release(proj)
+            return
+        # the projection is evaluated once: the target has been met
+        n_cancelled = self.cs.cancel(proj)
+        self.stopped[proj] = self.cs.nSubSims-n_cancelled
+        if n_cancelled > 0:
+            self.write_log("projection {}: relative noise {:.4g} after {} subSims, {} jobs cancelled".format(proj, noise, n, n_cancelled))
+        else:
+            self.log.debug("projection %d: relative noise %.4g after %d subSims, no job left to cancel", proj, noise, n)
+
+    # Called by the writer thread (or by the operator, if the write is already over) when a merged projection is 
+    # on disk. Errors are handed to intercomm_operator, which raises them.
+    def write_done(self, subSim, proj, curr_macfile, future):
+        if future.exception() is not None:
+            self.write_error = future.exception()
+            self.notify_operator()
+            return
+        self.write_times[proj] = time.time()
+        if self.perf is not None:
+            self.perf.projection_written(proj, self.write_times[proj])
+        self.write_log("job (%d,%d): received DONE writing", subSim, proj)
+        self.cs.changeState(subSim, proj, states.DONE)
+        self.n_written += 1
+        if not self.keep_macfile:
+            os.remove(curr_macfile)
+        self.notify_operator()
      
     def join(self):
         for thread in self.threadList:
             thread.join()
-        self.log.close()
+        self.collector.close()
+        close_log(self.log)
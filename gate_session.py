@@ -0,0 +1,88 @@
+
+# 
+# This file is part of the nn_3D-anomaly-detection distribution (https://github.com/mpiForGate/mpiForGate).
+# Copyright (c) 2022-2023 imec-Vision Lab, University of Antwerp.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import re, subprocess, sys
+from utils import *
+
+sys.excepthook = global_except_hook
+
+# A Gate application kept alive between the jobs of a rank, driven through its standard input. The first job 
+# executes its whole macfile (geometry, physics, /gate/run/initialize and the run); the next ones only send the 
+# commands which change from a job to the other (see macfile_template.get_session_commands), followed by a new 
+# /gate/application/start. Physics tables and geometry are therefore built once per rank instead of once per job.
+# The end of each run is detected by a sentinel echoed by Gate, the output of every run goes to its own log file.
+# Gate does not exit when an interactive command fails: the output of the job is scanned for the messages of the
+# commands which have been refused and of the G4Exceptions (but the warnings), which make the job fail.
+class gate_session:
+    
+    sentinel = 'mpiForGate: end of job'
+    # messages of the Geant4 UI managers (terminal and batch) for the commands which have not been executed
+    failure_markers = re.compile(r'command refused|command not found|command <[^>]*> not found|illegal parameter|illegal application state', re.IGNORECASE)
+
+    @classmethod
+    def is_failure(cls, line):
+        if 'G4Exception-START' in line: # the banner of the warnings is made of WWWW, that of the errors of EEEE
+            return 'WWWW' not in line
+        return cls.failure_markers.search(line) is not None
+
+    def __init__(self, template, executable='Gate'):
+        self.template = template
+        self.executable = executable
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([self.executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                                        stderr=subprocess.STDOUT, text=True, bufsize=1)
+
+    # Runs the job described by gate_macfile and returns 0 once it is over, 1 if a command failed, or the return code
+    # of Gate if it exited in the meantime. After a failure, the next job starts a new session.
+    def run(self, gate_macfile, log_path):
+        if self.process is None:
+            self.start()
+            commands = ['/control/execute '+gate_macfile+'\n']
+        else:
+            commands = self.template.get_session_commands(gate_macfile)
+        commands.append('/control/echo '+self.sentinel+'\n')
+        failed = False
+        with open(log_path, 'w') as log:
+            try:
+                self.process.stdin.writelines(commands)
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                pass
+            for line in self.process.stdout:
+                log.write(line)
+                failed = failed or self.is_failure(line)
+                if line.rstrip().endswith(self.sentinel) and '/control/echo' not in line:
+                    if not failed:
+                        return 0
+                    self.close()
+                    return 1
+        rc = self.process.wait()
+        self.process = None
+        return rc if rc != 0 else -1
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write('exit\n')
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process = None
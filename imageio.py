@@ -19,6 +19,7 @@
 
 
 import os, sys, pathlib
+from threading import Lock
 import itk
 import itk.support.types as itkt
 import numpy as np
@@ -47,12 +48,111 @@ npType2itkType = {
     'float64': itk.D,
 }
 
+# Container backends: all the images of a stack are held in a single file and addressed by index, so that an image 
+# can be written (or read) without touching the others and without opening a file per image. A backend opens its file 
+# once; write(image, i, metadata) stores the image i, read(i) returns it (the whole stack if i is None).
+
+# A (n_images, ny, nx) volume in a .npy file, memory-mapped. It is created by the first write, with n_images slots, 
+# and opened in place if it exists. The .npy format has no room for metadata, which are not stored.
+class npy_backend():
+    def __init__(self, path, mode='r', n_images=None):
+        self.path = path
+        self.mode = mode
+        self.volume = np.load(path, mmap_mode='r' if mode=='r' else 'r+') if os.path.exists(path) or mode=='r' else None
+        self.n_images = self.volume.shape[0] if self.volume is not None else n_images
+        self.lock = Lock()
+
+    def read(self, i=None):
+        return np.array(self.volume if i is None else self.volume[i])
+
+    def read_metadata(self, i=None):
+        return {}
+
+    def write(self, image, i, metadata=None):
+        with self.lock:
+            if self.volume is None:
+                if self.n_images is None:
+                    raise Exception("The number of images is needed to create the volume {}.".format(self.path))
+                self.volume = np.lib.format.open_memmap(self.path, mode='w+', dtype=image.dtype, shape=(self.n_images,)+image.shape)
+        self.volume[i] = image
+        self.volume.flush()
+
+    def close(self):
+        if self.volume is not None and self.mode != 'r':
+            self.volume.flush()
+        self.volume = None
+
+# An HDF5 file (h5py is only needed by this backend). Every output is a dataset of the file, with one compressed chunk 
+# per image: writing an image only compresses and writes its own chunk. The datasets are created by the first write, 
+# with n_images slots (or as many as needed), and grow when an image beyond the last slot is written. The metadata 
+# of the images (a dict of scalars or arrays, e.g. angle, primaries and seeds of a projection) are stored by index in 
+# the datasets of the "metadata" group, shared by the outputs of the file.
+class hdf5_backend():
+    def __init__(self, path, mode='r', n_images=None, dataset='images', compression='gzip'):
+        try:
+            import h5py
+        except ImportError:
+            raise Exception("The hdf5 backend needs the h5py package, which is not installed (pip install h5py).")
+        self.path = path
+        self.mode = mode
+        self.dataset = dataset
+        self.compression = compression
+        self.file = h5py.File(path, 'r' if mode=='r' else 'a')
+        self.n_images = self.file[dataset].shape[0] if dataset in self.file else n_images
+        self.lock = Lock() # h5py serializes its calls, but the datasets are created and resized in several calls
+
+    def read(self, i=None):
+        return self.file[self.dataset][()] if i is None else self.file[self.dataset][i]
+
+    def read_metadata(self, i=None):
+        if 'metadata' not in self.file:
+            return {}
+        return {key: (dataset[()] if i is None else dataset[i]) for key, dataset in self.file['metadata'].items()}
+
+    def write_indexed(self, name, value, i, compressed):
+        if name not in self.file:
+            n_slots = max(self.n_images if self.n_images is not None else 0, i+1)
+            self.file.create_dataset(name, shape=(n_slots,)+value.shape, maxshape=(None,)+value.shape, dtype=value.dtype, 
+                                     chunks=(1,)+value.shape if compressed else True, 
+                                     compression=self.compression if compressed else None, shuffle=compressed)
+        dataset = self.file[name]
+        if dataset.shape[0] <= i:
+            dataset.resize(i+1, axis=0)
+        dataset[i] = value
+
+    def write(self, image, i, metadata=None):
+        with self.lock:
+            self.write_indexed(self.dataset, image, i, True)
+            for key, value in (metadata if metadata is not None else {}).items():
+                self.write_indexed('metadata/'+key, np.asarray(value), i, False)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+container_backends = {'npy': npy_backend, 'hdf5': hdf5_backend}
+
+# The backend of a path given without backend: a container for the .npy and HDF5 extensions, ITK otherwise
+def get_backend_name(path):
+    ext = os.path.splitext(path)[1].lower() if isinstance(path, str) else None
+    return {'.npy': 'npy', '.h5': 'hdf5', '.hdf5': 'hdf5'}.get(ext, 'itk')
+
+# With the ITK backend (the default), every image is a file, read and written by ITK (a '*' in the path, or a list of 
+# paths, reads a series). With a container backend, the images are addressed by index in a single file: the options 
+# are given to the backend (n_images, and the dataset name for HDF5), and write_image needs the index of the image.
 class stack_images():
-    def __init__(self, path, mode='r'):
+    def __init__(self, path, mode='r', backend=None, **options):
         self.mode = mode
         self.path = path
+        self.backend = backend if backend is not None else get_backend_name(path)
+        self.container = None
         
-        if self.mode in ['r','rw']:
+        if self.backend != 'itk':
+            if self.backend not in container_backends:
+                raise Exception("Unknown image backend {}, it should be one of: itk, {}.".format(self.backend, ', '.join(container_backends)))
+            self.container = container_backends[self.backend](path, mode, **options)
+            self.n_images = self.container.n_images
+        elif self.mode in ['r','rw']:
             self.set_imageio()
             self.n_images = self.read_n_images()
             self.nx, self.ny = self.get_image_shape()
@@ -85,6 +185,7 @@ class stack_images():
         mode = itk.CommonEnums.IOFileMode_ReadMode if self.mode in ['r','rw'] else itk.CommonEnums.IOFileMode_WriteMode
         input_file = self.get_files()[0]
         imageIO = itk.ImageIOFactory.CreateImageIO(input_file, mode)
+        imageIO.SetFileName(input_file)
         # try
         try:
             imageIO.ReadImageInformation()
@@ -93,25 +194,40 @@ class stack_images():
         self.imageIO = imageIO
         
     def get_image(self, i=0):
-        if self.mode in ['r','rw']:
+        if self.mode in ['r','rw'] and self.container is not None:
+            return self.container.read(i)
+        elif self.mode in ['r','rw']:
             img = self.read(self.get_files()[i])
             return img
         else:
             raise Exception("The image cannot be read because the stack has not been declared in read mode.")
         
     def get_stack(self):
-        if self.mode in ['r','rw']:
+        if self.mode in ['r','rw'] and self.container is not None:
+            return self.container.read()
+        elif self.mode in ['r','rw']:
             img = self.read(self.get_files())
             img = np.expand_dims(img, 0) if self.n_images==1 else img
             return img
         else:
             raise Exception("The image cannot be read because the stack has not been declared in read mode.")
         
-    def write_image(self, img):
-        if self.mode in ['w','rw']:
+    def get_metadata(self, i=None):
+        return self.container.read_metadata(i) if self.container is not None else {}
+        
+    def write_image(self, img, i=None, metadata=None):
+        if self.mode in ['w','rw'] and self.container is not None:
+            if i is None:
+                raise Exception("The index of the image is needed to write it in the container {}.".format(self.path))
+            self.container.write(img, i, metadata)
+        elif self.mode in ['w','rw']:
             self.write(img)
         else:
             raise Exception("The image cannot be saved because the stack has not been declared in write mode.")
+            
+    def close(self):
+        if self.container is not None:
+            self.container.close()
     
     def make_filepath(self,i):
         formattable_path = self.path.replace('*','{}') if  '*' in self.path else self.path
@@ -0,0 +1,159 @@
+
+# 
+# This file is part of the nn_3D-anomaly-detection distribution (https://github.com/mpiForGate/mpiForGate).
+# Copyright (c) 2022-2023 imec-Vision Lab, University of Antwerp.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json, logging, logging.handlers, queue, sys, time
+from datetime import datetime
+from threading import Thread, Event
+from utils import *
+
+__all__ = ['setup_logging', 'get_log', 'close_log', 'flush_logs', 'shutdown_logging', 'log_levels']
+sys.excepthook = global_except_hook
+
+# Logs of the manager, the collector, the state machine and the workers. A log is a logging.Logger writing to its own
+# file: the records are handed over to a writer thread (one per process), which formats them and writes them to
+# buffered files. Records below the level are dropped by the Logger before anything is formatted, so that the debug
+# messages of the hot paths cost a level check, as long as they are logged with arguments (log.debug('%s', x)) and
+# not with an already formatted string. The arguments are formatted on the writer thread: they must not be changed
+# after the call.
+
+log_levels = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+# "hh:mm:ss: message", as the logs have always been written
+class text_formatter(logging.Formatter):
+    def format(self, record):
+        line = datetime.fromtimestamp(record.created).strftime("%H:%M:%S")+': '+record.getMessage()
+        return line+('\n'+self.formatException(record.exc_info) if record.exc_info else '')
+
+# One JSON object per line: time (seconds since the epoch), level, log, rank and message, plus the fields given as
+# extra={'fields': {...}} to the logging call
+class json_formatter(logging.Formatter):
+    def __init__(self, rank):
+        super().__init__()
+        self.rank = rank
+
+    def format(self, record):
+        entry = {'time': round(record.created, 6), 'level': record.levelname.lower(), 'log': record.name.split('.')[-1], 
+                 'rank': self.rank, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Hands the records over to the writer as they are, without formatting them on the calling thread
+class async_handler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Writes the records of all the logs of the process on its own thread. The files are flushed at most flush_interval 
+# seconds after a record has been written to them, right away for warnings and errors, and when they are closed.
+class log_writer:
+    def __init__(self, formatter, flush_interval):
+        self.formatter = formatter
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.files = {} # logger name -> file
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def open(self, name, path):
+        self.queue.put(('open', name, open(path, 'w', buffering=1<<16)))
+
+    # Runs a command on the writer thread and waits for it: 'flush' all the files, 'close' the file of a log, or 
+    # 'stop' the writer once all the files are closed
+    def command(self, command, name=None, timeout=None):
+        done = Event()
+        self.queue.put((command, name, done))
+        return done.wait(timeout)
+
+    def run(self):
+        dirty = set()
+        deadline = None
+        while True:
+            try:
+                item = self.queue.get(timeout=None if deadline is None else max(deadline-time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            if isinstance(item, logging.LogRecord):
+                f = self.files.get(item.name)
+                if f is None: # logged after close_log
+                    continue
+                f.write(self.formatter.format(item)+'\n')
+                if item.levelno >= logging.WARNING:
+                    f.flush()
+                else:
+                    dirty.add(f)
+                    deadline = deadline if deadline is not None else time.monotonic()+self.flush_interval
+                continue
+            if item is not None and item[0] == 'open':
+                self.files[item[1]] = item[2]
+                continue
+            # the interval is over, or a command
+            for f in dirty:
+                f.flush()
+            dirty, deadline = set(), None
+            if item is None:
+                continue
+            command, name, done = item
+            if command == 'close' and name in self.files:
+                self.files.pop(name).close()
+            elif command == 'stop':
+                for f in self.files.values():
+                    f.close()
+                self.files = {}
+                done.set()
+                return
+            done.set()
+
+writer = None
+settings = {'level': logging.INFO, 'format': 'text', 'flush_interval': 1., 'rank': 0}
+
+# Sets the level ('debug', 'info', 'warning' or 'error'), the format ('text' or 'json') and the flush interval (in 
+# seconds) of the logs opened afterwards, and starts the writer thread
+def setup_logging(level='info', fmt='text', flush_interval=1., rank=0):
+    global writer
+    if writer is not None:
+        shutdown_logging()
+    settings.update({'level': log_levels[level], 'format': fmt, 'flush_interval': flush_interval, 'rank': rank})
+    formatter = json_formatter(rank) if fmt == 'json' else text_formatter()
+    writer = log_writer(formatter, flush_interval)
+
+# Returns the log called name, writing to path (which is overwritten)
+def get_log(name, path):
+    if writer is None:
+        setup_logging()
+    log = logging.getLogger('mpiForGate.'+name)
+    log.setLevel(settings['level'])
+    log.propagate = False
+    log.handlers = [async_handler(writer.queue)]
+    writer.open(log.name, path)
+    return log
+
+# Writes what is left of the log and closes its file. The records logged afterwards are lost.
+def close_log(log):
+    if writer is not None:
+        writer.command('close', log.name)
+
+# Writes the records logged so far, e.g. before aborting (it gives up after timeout seconds)
+def flush_logs(timeout=None):
+    if writer is not None:
+        writer.command('flush', timeout=timeout)
+
+def shutdown_logging():
+    global writer
+    if writer is not None:
+        writer.command('stop')
+        writer = None
@@ -15,102 +15,223 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import os
+import os, bisect, hashlib, logging
+from collections import OrderedDict
+
+
+# Formats one line of a macfile, as written by macfile.write()
+def format_line(cmd, value):
+    value_to_write = []
+    for value_elem in value:
+        value_elem = value_elem if not isinstance(value_elem, float) else '{0:,.5f}'.format(value_elem)
+        value_elem = value_elem if not isinstance(value_elem, int) else str(value_elem)
+        value_to_write.append(value_elem)
+    try:
+        return ' '.join([cmd,] + value_to_write + ['\n',])
+    except Exception as e:
+        raise ValueError('Error in writing cmd {} with value {}, becase of {}'.format(cmd, value, e))
+
+
+# Cache of the parsed macros included with /control/execute, by content hash: the same macros (geometry, physics, 
+# ...) are included by every macfile of the scan, whereas the macfiles themselves are always parsed again. Only the
+# max_cached_macros most recently used macros are kept.
+parsed_macros = OrderedDict()
+max_cached_macros = 32
+
+# Returns the commands and values of the content of a macfile, without empty lines and comments
+def parse_content(content):
+    commands, values = [], []
+    for line in content.splitlines():
+        line = line.strip()
+        line = line.split('#', 1)[0]
+        if line=='':
+            continue
+        line_segm = line.split()
+        commands.append(line_segm[0])
+        values.append(line_segm[1:])
+    return commands, values
+
+# Returns the commands and values of a macfile, as lists of strings, without empty lines and comments
+def parse_lines(macfile):
+    with open(macfile, 'rb') as f:
+        return parse_content(f.read().decode())
+
+# As parse_lines, for an included macro: its content is read again, but not parsed if it did not change
+def parse_macro(macro):
+    with open(macro, 'rb') as f:
+        content = f.read()
+    content_hash = hashlib.sha1(content).hexdigest()
+    if content_hash in parsed_macros:
+        parsed_macros.move_to_end(content_hash)
+    else:
+        parsed_macros[content_hash] = parse_content(content.decode())
+        if len(parsed_macros) > max_cached_macros:
+            parsed_macros.popitem(last=False)
+    commands, values = parsed_macros[content_hash]
+    return list(commands), [list(value) for value in values]
+
+# Replaces every "/control/execute <macro>" with the (recursively flattened) commands of the macro. Relative macro 
+# paths are looked for next to the including macfile first, then next to the main macfile, then in the working 
+# directory (as GATE does). A macro which is not found is left to GATE (e.g. in its macro path, or on a path which 
+# only exists on the compute nodes): the line is kept as it is.
+def flatten_includes(macfile, commands, values, including=()):
+    macfile = os.path.abspath(macfile)
+    search_dirs = [os.path.dirname(macfile), os.path.dirname(including[0]) if len(including) > 0 else os.path.dirname(macfile)]
+    if macfile in including:
+        raise Exception('Recursive inclusion of {} in {}'.format(macfile, including[-1]))
+    flat_commands, flat_values = [], []
+    for cmd, value in zip(commands, values):
+        if cmd != '/control/execute':
+            flat_commands.append(cmd)
+            flat_values.append(value)
+            continue
+        macro = value[0]
+        if not os.path.isabs(macro):
+            for search_dir in search_dirs:
+                if os.path.exists(os.path.join(search_dir, macro)):
+                    macro = os.path.join(search_dir, macro)
+                    break
+        if not os.path.exists(macro):
+            logging.getLogger('mpiForGate.macfile').warning('macro %s (included in %s) not found, left to GATE', value[0], macfile)
+            flat_commands.append(cmd)
+            flat_values.append(value)
+            continue
+        macro_commands, macro_values = parse_macro(macro)
+        macro_commands, macro_values = flatten_includes(macro, macro_commands, macro_values, including+(macfile,))
+        flat_commands += macro_commands
+        flat_values += macro_values
+    return flat_commands, flat_values
 
 
 class macfile:
-    def __init__(self, macfile=None):
+    # Commands are stored as an ordered dict of entries (entry id -> [command, values]), where entry ids grow with 
+    # the position in the file. An index maps every command to the ids of its entries, so that lookups and updates 
+    # do not scan the whole macfile. find_cmd() uses a sorted index of the '/'-suffixes of the distinct commands.
+    # With resolve_includes, the macros called with /control/execute are inlined (see flatten_includes)
+    def __init__(self, macfile=None, resolve_includes=False):
         self.is_macfile_loaded = False
+        self.clear()
         if macfile is not None:
             self.macfile_path = os.path.abspath(macfile)
-            self.load(macfile)
+            self.load(macfile, resolve_includes)
 
-    def load(self, macfile):
+    def load(self, macfile, resolve_includes=False):
         self.macfile_path = os.path.abspath(macfile)
-        with open(macfile, 'r') as f:
-            macfile_lines = f.readlines()
-        
-        lines_to_delete = []
-        for i, line in enumerate(macfile_lines):
-            line = line.strip()
-            line = line.split('#', 1)[0]
-            if line=='':
-                lines_to_delete.append(i)
-            macfile_lines[i] = line
-
-        for i in reversed(lines_to_delete):
-            macfile_lines.pop(i)
-
-        self.commands = []
-        self.values = []
-        for line in macfile_lines:
-            line_segm = line.split()
-            self.commands.append(line_segm[0])
-            self.values.append(line_segm[1:])
-            
+        commands, values = parse_lines(macfile)
+        if resolve_includes:
+            commands, values = flatten_includes(macfile, commands, values)
+        self.load_commands(commands, values)
+
+    def clear(self):
+        self.entries = {}
+        self.index = {}
+        self.next_id = 0
+        self.suffix_index = None
+
+    # Loads commands and values which do not come from a file
+    def load_commands(self, commands, values):
+        self.clear()
+        for cmd, value in zip(commands, values):
+            self.append(cmd, value)
         self.is_macfile_loaded = True
 
-    def write(self, new_path):
+    @property
+    def commands(self):
+        return [entry[0] for entry in self.entries.values()]
+
+    @property
+    def values(self):
+        return [entry[1] for entry in self.entries.values()]
+
+    def append(self, cmd, value):
+        self.entries[self.next_id] = [cmd, value]
+        if cmd not in self.index:
+            self.index[cmd] = []
+            self.suffix_index = None
+        self.index[cmd].append(self.next_id)
+        self.next_id += 1
+
+    def delete(self, entry_id):
+        cmd = self.entries.pop(entry_id)[0]
+        self.index[cmd].remove(entry_id)
+        if len(self.index[cmd]) == 0:
+            del self.index[cmd]
+            self.suffix_index = None
+
+    # Number of times cmd appears in the macfile
+    def count(self, cmd):
+        return len(self.index.get(cmd, []))
+
+    # Returns the lines written by write(), together with the command of each line
+    def get_lines(self):
         assert self.is_macfile_loaded, 'No macfile has been read'
         to_be_last_command='/gate/application/start'
+        cmds, lines = [], []
+        for cmd, value in self.entries.values():
+            if cmd != to_be_last_command:
+                cmds.append(cmd)
+                lines.append(format_line(cmd, value))
+        cmds.append(to_be_last_command)
+        lines.append(' '.join([to_be_last_command] + ['\n',])) # last command
+        return cmds, lines
+
+    def write(self, new_path):
+        _, lines = self.get_lines()
         with open(new_path, 'w') as f:
-            for cmd, value in zip(self.commands, self.values):
-                if cmd != to_be_last_command:
-                    #print([line]+self.macfile_dict[line]+['\n'])
-                    value_to_write = []
-                    for value_elem in value:
-                        value_elem = value_elem if not isinstance(value_elem, float) else '{0:,.5f}'.format(value_elem)
-                        value_elem = value_elem if not isinstance(value_elem, int) else str(value_elem)
-                        value_to_write.append(value_elem)
-                    try:
-                        f.write(' '.join([cmd,] + value_to_write + ['\n',]))
-                    except Exception as e:
-                        raise ValueError('Error in writing cmd {} with value {}, becase of {}'.format(cmd, value, e))
-            f.write(' '.join([to_be_last_command] + ['\n',])) # last command
+            f.writelines(lines)
 
     def get(self, cmd, default=None):
-        try:
-            return self.values[self.commands.index(cmd)]
-        except:
-            return default
+        entry_ids = self.index.get(cmd)
+        return self.entries[entry_ids[0]][1] if entry_ids else default
+
+    # Sorted list of (suffix, cmd), where the suffixes are the tails of each distinct command starting at a '/'. 
+    # A pattern starting with '/' is contained in a command iff it is the prefix of one of its suffixes.
+    def get_suffix_index(self):
+        if self.suffix_index is None:
+            self.suffix_index = []
+            for cmd in self.index:
+                for i, char in enumerate(cmd):
+                    if char == '/':
+                        self.suffix_index.append((cmd[i:], cmd))
+            self.suffix_index.sort()
+        return self.suffix_index
         
     # finds the all commands that contains cmd_pattern
     def find_cmd(self, cmd_pattern):
-        list_of_cmds = []
-        for cmd in self.commands:
-            if cmd_pattern in cmd:
-                list_of_cmds.append(cmd)
-        return list_of_cmds
+        if cmd_pattern.startswith('/'):
+            suffix_index = self.get_suffix_index()
+            matching_cmds = set()
+            i = bisect.bisect_left(suffix_index, (cmd_pattern,))
+            while i < len(suffix_index) and suffix_index[i][0].startswith(cmd_pattern):
+                matching_cmds.add(suffix_index[i][1])
+                i += 1
+        else:
+            matching_cmds = [cmd for cmd in self.index if cmd_pattern in cmd]
+        entry_ids = sorted([entry_id for cmd in matching_cmds for entry_id in self.index[cmd]])
+        return [self.entries[entry_id][0] for entry_id in entry_ids]
     
     def find_value(self, value_pattern):
         tuple_cmd_value = []
-        for cmd, value in zip(self.commands, self.values):
+        for cmd, value in self.entries.values():
             if value_pattern in value:
                 tuple_cmd_value.append((cmd, value))
         return tuple_cmd_value
         
     def remove(self, cmd):
-        idx = self.commands.index(cmd)
-        self.commands.pop(idx)
-        self.values.pop(idx)
+        if cmd not in self.index:
+            raise ValueError('{} is not in the macfile'.format(cmd))
+        self.delete(self.index[cmd][0])
         
     def pop(self, cmd, default=None):
-        try:
-            idx = self.commands.index(cmd)
-            self.commands.pop(idx)
-            return self.values.pop(idx)
-        except:
+        entry_ids = self.index.get(cmd)
+        if not entry_ids:
             return default
+        value = self.entries[entry_ids[0]][1]
+        self.delete(entry_ids[0])
+        return value
 
     def update(self, curr_cmd, curr_value):
         # curr_cmd can be a list of commands. In this case, curr_value must be a list of lists
-        # curr_cmd   = curr_cmd   if isinstance(curr_cmd, list)      else [curr_cmd]
-        # if len(curr_cmd) > 0:
-        #     curr_value = curr_value if isinstance(curr_value[0], list) else [curr_value]
-        # else:
-        #     curr_value = curr_value if isinstance(curr_value, list) else [curr_value]
-        
-            
         if not isinstance(curr_cmd, list):
             curr_cmd = [curr_cmd]
             if not isinstance(curr_value, list):
@@ -123,14 +244,13 @@ class macfile:
         else:
             assert len(curr_cmd)==len(curr_value), 'curr_cmd and curr_value must have the same length'
         
-        # separate the commands that appear more than once
+        # separate the commands that appear exactly once from the others (new or duplicated commands)
         unique_cmds = []
         values_of_unique_cmds = []
         duplicate_cmds = []
         values_of_duplicate_cmds = []
         for cmd_to_check, value in zip(curr_cmd, curr_value):
-            indices =[i for i, cmd in enumerate(self.commands) if cmd == cmd_to_check]
-            if len(indices)==1:
+            if self.count(cmd_to_check)==1:
                 unique_cmds.append(cmd_to_check)
                 values_of_unique_cmds.append(value)
             else:
@@ -139,38 +259,79 @@ class macfile:
         
         for cmd_to_modify, value_to_modify in zip(unique_cmds, values_of_unique_cmds):
             new_value = value_to_modify if isinstance(value_to_modify, list) else [value_to_modify]
-            try: # cmd_to_modify is already known
-                indices = [i for i, x in enumerate(self.commands) if x == cmd_to_modify]
-                #idx = self.commands.index(cmd_to_modify)
-                
-                if len(indices)>1:# If there is more than one, remove all the duplicates after the first from self.commands and self.values
-                    for index in sorted(indices, reverse=True):
-                        del self.commands[index]
-                        del self.values[index]
-                    self.commands.append(cmd_to_modify)
-                    self.values.append(new_value)
-                else:
-                    for i, new_value_element in enumerate(new_value):
-                        self.values[indices[0]][i] = new_value_element # assumes that the new values have less or same number of elements
-            except ValueError: # the cmd is new
-                self.commands.append(cmd_to_modify)
-                self.values.append(new_value)
+            entry_ids = list(self.index.get(cmd_to_modify, []))
+            if len(entry_ids)>1:# If there is more than one, remove all of them and append the new value
+                for entry_id in entry_ids:
+                    self.delete(entry_id)
+                self.append(cmd_to_modify, new_value)
+            else:
+                for i, new_value_element in enumerate(new_value):
+                    self.entries[entry_ids[0]][1][i] = new_value_element # assumes that the new values have less or same number of elements
         
+        # commands which are new or appear more than once are (re)appended at the end of the macfile
         for cmd_to_check in duplicate_cmds:
-            indices = [i for i, x in enumerate(self.commands) if x == cmd_to_check]
-            for index in sorted(indices, reverse=True):
-                del self.commands[index]
-                del self.values[index]
+            for entry_id in list(self.index.get(cmd_to_check, [])):
+                self.delete(entry_id)
         for cmd_to_add, value_to_add in zip(duplicate_cmds, values_of_duplicate_cmds):
-            self.commands.append(cmd_to_add)
-            self.values.append(value_to_add)
-            
-        
+            self.append(cmd_to_add, value_to_add)
+
+
+# Microbenchmark on a synthetic macfile, with many voxelised-phantom-like lines and some repeated commands
+def benchmark(n_lines=100000, n_queries=1000):
+    import tempfile, time
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'synthetic.mac')
+        with open(path, 'w') as f:
+            for i in range(n_lines):
+                if i%10 == 0:
+                    f.write('/gate/phantom/geometry/insertMaterial Material{}\n'.format(i))
+                else:
+                    f.write('/gate/phantom/voxel{}/setMaterial Water{}\n'.format(i, i%7))
+            f.write('/gate/application/start\n')
+
+        start = time.perf_counter()
+        mr = macfile(path)
+        print('load of {} lines: {:.3f} s'.format(n_lines, time.perf_counter()-start))
+
+        cmds = ['/gate/phantom/voxel{}/setMaterial'.format(i) for i in range(1, n_lines, max(1, n_lines//n_queries))]
+        start = time.perf_counter()
+        for cmd in cmds:
+            mr.get(cmd)
+        print('{} get: {:.3f} s'.format(len(cmds), time.perf_counter()-start))
+
+        start = time.perf_counter()
+        mr.update(cmds, [['Air'] for cmd in cmds])
+        print('update of {} commands: {:.3f} s'.format(len(cmds), time.perf_counter()-start))
+
+        start = time.perf_counter()
+        mr.find_cmd('/insertMaterial')
+        print('first find_cmd (builds the suffix index): {:.3f} s'.format(time.perf_counter()-start))
+
+        start = time.perf_counter()
+        for cmd in cmds:
+            mr.find_cmd(cmd[cmd.find('/voxel'):])
+        print('{} find_cmd: {:.3f} s'.format(len(cmds), time.perf_counter()-start))
+
+        start = time.perf_counter()
+        mr.update('/gate/phantom/geometry/insertMaterial', ['Air']) # duplicated command
+        mr.pop('/gate/phantom/voxel1/setMaterial')
+        print('update of a duplicated command and pop: {:.3f} s'.format(time.perf_counter()-start))
+
+        start = time.perf_counter()
+        mr.write(os.path.join(tmp_dir, 'synthetic_mod.mac'))
+        print('write: {:.3f} s'.format(time.perf_counter()-start))
             
             
 if __name__ == '__main__':
-    mr = macfile()
-    mr.load('tests/simple_macfile/processCT.mac')
-    mr.update('/gate/source/mybeam/gps/pos/centre', [-1, -1, -1]) # update a cmd
-    mr.update('/gate/source/mybeam/gps/pos/centre2', [0, 1, 2]) # insert a cmd
-    mr.write('tests/simple_macfile/processCT_mod.mac')
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', action=argparse.BooleanOptionalAction, default=False)
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+    else:
+        mr = macfile()
+        mr.load('tests/simple_macfile/processCT.mac')
+        mr.update('/gate/source/mybeam/gps/pos/centre', [-1, -1, -1]) # update a cmd
+        mr.update('/gate/source/mybeam/gps/pos/centre2', [0, 1, 2]) # insert a cmd
+        mr.write('tests/simple_macfile/processCT_mod.mac')
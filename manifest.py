@@ -0,0 +1,97 @@
+
+# 
+# This file is part of the nn_3D-anomaly-detection distribution (https://github.com/mpiForGate/mpiForGate).
+# Copyright (c) 2022-2023 imec-Vision Lab, University of Antwerp.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json, os, sys
+import numpy as np
+from datetime import datetime
+from utils import *
+
+sys.excepthook = global_except_hook
+
+# The run manifest is a JSON file next to the macfile (<jobName>.manifest.json) describing how the outputs of the
+# scan have been produced: the macfile, the number of projections and, for every run which contributed to the 
+# outputs, its index, its master seed, its split and its primaries, its start/end times and whether it completed. 
+# The master seeds of the previous runs let a resumed run regenerate the same seeds, and a top-up run draw new ones.
+# The outputs are sums over all the runs: the primaries per projection are the sum of those of the runs. Once a run 
+# is completed, projection_primaries holds, for each projection, the nominal primaries of its output (those of all
+# the jobs of all the runs, counted in jobs if the macfile does not set them) and the simulated ones (without the 
+# jobs cancelled by the early stopping or which have failed, with failed_projections='rescale').
+class manifest:
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path
+        self.clear()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.content = json.load(f)
+
+    def clear(self):
+        self.content = {'macfile': None, 'n_projs': None, 'primaries_per_projection': None, 'projection_primaries': None, 'runs': []}
+
+    @property
+    def runs(self):
+        return self.content['runs']
+
+    def last_run(self):
+        return self.runs[-1] if len(self.runs) > 0 else None
+
+    # Records a new run of the template (whose seeds have already been drawn) and saves the manifest
+    def add_run(self, template, macfile_path):
+        n_primaries = template.primaries.n_primaries
+        self.content.update({'macfile': os.path.abspath(macfile_path), 'n_projs': template.get_n_projs()})
+        self.runs.append({'run_index': template.seed.run_index, 'master_seed': int(template.seed.master_seed),
+                          'macfile_hash': template.macfile_hash, 'n_processes': template.get_n_processes(), 'seed_stride': template.seed_stride,
+                          'primaries_per_run': n_primaries, 'adaptive': template.max_splits is not None,
+                          'primaries_per_projection': n_primaries*template.get_n_processes() if n_primaries is not None else None,
+                          'started': datetime.now().isoformat(timespec='seconds'), 'completed': None})
+        primaries = [run['primaries_per_projection'] for run in self.runs]
+        self.content['primaries_per_projection'] = sum(primaries) if None not in primaries else None
+        self.save()
+
+    # Records the jobs of the last run which failed for good (see collectorManager.get_failures), appended to those of
+    # the interrupted run when resuming, the number of jobs which succeeded when retried, and how the projections of
+    # the failed jobs have been completed ('rescale' or 'flag')
+    def record_failures(self, failures, n_recovered, failed_projections):
+        run = self.last_run()
+        run['failed_jobs'] = run.get('failed_jobs', [])+failures
+        run['recovered_jobs'] = run.get('recovered_jobs', 0)+n_recovered
+        run['failed_projections'] = failed_projections
+        self.save()
+
+    # Returns the nominal and the simulated primaries of each projection (see collectorManager.get_scales) in the 
+    # outputs of the runs before the last one. The manifests which do not record them count all the jobs as simulated.
+    def get_base_primaries(self, n_projs):
+        if self.content.get('projection_primaries') is not None:
+            primaries = self.content['projection_primaries']
+            return np.array(primaries['nominal'], dtype=np.float64), np.array(primaries['simulated'], dtype=np.float64)
+        nominal = sum(run['primaries_per_projection'] if run['primaries_per_projection'] is not None else run['n_processes'] 
+                      for run in self.runs[:-1])
+        return np.full(n_projs, float(nominal)), np.full(n_projs, float(nominal))
+
+    def record_projection_primaries(self, nominal, simulated):
+        self.content['projection_primaries'] = {'nominal': [float(n) for n in nominal], 'simulated': [float(s) for s in simulated]}
+        self.save()
+
+    def complete_run(self):
+        self.last_run()['completed'] = datetime.now().isoformat(timespec='seconds')
+        self.save()
+
+    # Written aside and renamed, so that an interrupted run does not leave a truncated manifest
+    def save(self):
+        with open(self.path+'.part', 'w') as f:
+            json.dump(self.content, f, indent=2)
+        os.replace(self.path+'.part', self.path)
@@ -0,0 +1,160 @@
+
+# 
+# This file is part of the nn_3D-anomaly-detection distribution (https://github.com/mpiForGate/mpiForGate).
+# Copyright (c) 2022-2023 imec-Vision Lab, University of Antwerp.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from mpi4py import MPI
+import sys, time
+import numpy as np
+from utils import *
+from perf import worker_spans
+
+__all__ = ['message_dtypes', 'max_images', 'messenger', 'report_errors']
+sys.excepthook = global_except_hook
+
+# The messages exchanged by the manager and the workers. Every type of message (a signal) has its own tag, equal to 
+# the value of the signal, and its own payload: a record of a NumPy structured dtype, sent as raw bytes. A new type of
+# message needs a signal and an entry in message_dtypes. The messages travel on a duplicate of the communicator, so 
+# that probing for any tag only matches messages, not the collectives. The output images of a job (transfer='mpi') 
+# follow its DONE (or REDUCED) message on a second duplicate, where the receiver posts their receives against the 
+# dtypes and shapes announced by the message (image_fields).
+job_fields = [('subSim', np.int32), ('proj', np.int32)]
+max_images, max_ndim = 8, 3
+image_fields = [('n_images', np.int32), ('image_dtype', np.int8, (max_images,)), ('image_ndim', np.int8, (max_images,)), 
+                ('image_shape', np.int64, (max_images, max_ndim))]
+message_dtypes = {
+    signals.REQUEST: np.dtype(job_fields),
+    # the number of jobs of the projection, and the attempt (0 for the first run of the job, see FAILED)
+    signals.WORK:    np.dtype(job_fields+[('n_splits', np.int32), ('attempt', np.int32)]),
+    signals.CLOSE:   np.dtype(job_fields),
+    # (start, end) of the steps of the job (see perf.worker_spans), NaN when not measured
+    signals.DONE:    np.dtype(job_fields+[('timing', np.float64, (2*len(worker_spans),))]+image_fields),
+    # the group leader sends the sum of the n_subsims subSims of the projection (tree reduction), in double precision,
+    # and the dtypes of the outputs (see utils.image_dtypes)
+    signals.REDUCED: np.dtype(job_fields+[('n_subsims', np.int32), ('timing', np.float64, (2*len(worker_spans),)),
+                                          ('out_dtype', np.int8, (max_images,))]+image_fields),
+    # an uncaught exception on a worker, with its traceback (truncated), and the job it was running (-1 if none)
+    signals.ERROR:   np.dtype(job_fields+[('text', 'S4096')]),
+    # rank 0 has logged the ERROR of the worker
+    signals.ACK:     np.dtype(job_fields),
+    # a job which failed (Gate returned rc) on rank, at its attempt-th run: final if the worker does not run it again
+    # itself, with the end of its log. The group leader reports the failures of its group (tree reduction).
+    signals.FAILED:  np.dtype(job_fields+[('rank', np.int32), ('attempt', np.int32), ('rc', np.int32), ('final', np.int8), ('text', 'S1024')]),
+}
+
+# Non-blocking, typed messaging. send() returns as soon as the message is posted (Isend); the buffers of the sends in
+# flight are kept until they complete, which is checked at every send and poll (or waited for by flush). poll() 
+# returns the next message if there is one (matched probe, Improbe), without blocking; recv() waits for one.
+class messenger:
+    def __init__(self, comm):
+        self.comm = comm.Dup()
+        self.image_comm = comm.Dup()
+        self.in_flight = [] # (request, buffer)
+        self.job = (-1, -1) # (subSim, proj) of the job being run by the worker, for the ERROR messages
+
+    # The images, if any, are described in the message and sent after it
+    def send(self, signal, dest, images=(), **fields):
+        record = np.zeros(1, dtype=message_dtypes[signal])
+        for name, value in fields.items():
+            record[name] = value.encode()[:record.dtype[name].itemsize] if isinstance(value, str) else value
+        images = [np.ascontiguousarray(image) for image in images]
+        if len(images) > 0:
+            record['n_images'] = len(images)
+            for i, image in enumerate(images):
+                record['image_dtype'][0,i] = get_image_dtype_code(image.dtype)
+                record['image_ndim'][0,i] = image.ndim
+                record['image_shape'][0,i,:image.ndim] = image.shape
+        request = self.comm.Isend([record.view(np.uint8), MPI.BYTE], dest=dest, tag=signal.value)
+        self.in_flight.append((request, record))
+        for image in images:
+            self.in_flight.append((self.image_comm.Isend(image, dest=dest, tag=IMAGE_TAG), image))
+        self.complete_sends()
+        return request
+
+    # Posts the receives of the images announced by a message from source. Returns the requests and the buffers of the
+    # images, which can be used once all the requests are complete.
+    def recv_images(self, source, record):
+        requests, images = [], []
+        for i in range(int(record['n_images'])):
+            image = np.empty(record['image_shape'][i,:record['image_ndim'][i]], dtype=image_dtypes[record['image_dtype'][i]])
+            requests.append(self.image_comm.Irecv(image, source=source, tag=IMAGE_TAG))
+            images.append(image)
+        return requests, images
+
+    def complete_sends(self):
+        self.in_flight = [(request, record) for request, record in self.in_flight if not request.Test()]
+
+    # Waits for all the messages sent to be delivered (e.g. before exiting, or aborting)
+    def flush(self, timeout=None):
+        start = time.time()
+        while len(self.in_flight) > 0:
+            self.complete_sends()
+            if timeout is not None and time.time()-start > timeout:
+                return False
+            time.sleep(1e-3) if len(self.in_flight) > 0 else None
+        return True
+
+    def receive(self, message, status):
+        signal = signals(status.Get_tag())
+        record = np.empty(1, dtype=message_dtypes[signal])
+        message.Recv([record.view(np.uint8), MPI.BYTE])
+        return signal, status.Get_source(), record[0]
+
+    # Returns (signal, source rank, record) of the next message from source, or None if there is none yet
+    def poll(self, source=MPI.ANY_SOURCE):
+        self.complete_sends()
+        status = MPI.Status()
+        message = self.comm.Improbe(source=source, tag=MPI.ANY_TAG, status=status)
+        if message is None:
+            return None
+        return self.receive(message, status)
+
+    def recv(self, source=MPI.ANY_SOURCE):
+        status = MPI.Status()
+        message = self.comm.Mprobe(source=source, tag=MPI.ANY_TAG, status=status)
+        return self.receive(message, status)
+
+    # Waits for a message of the given signal from source, for timeout seconds at most. Returns its record, or None.
+    def wait_for(self, signal, source, timeout):
+        start = time.time()
+        while time.time()-start < timeout:
+            status = MPI.Status()
+            message = self.comm.Improbe(source=source, tag=signal.value, status=status)
+            if message is not None:
+                return self.receive(message, status)[2]
+            time.sleep(1e-3)
+        return None
+
+    def free(self):
+        self.flush()
+        self.comm.Free()
+        self.image_comm.Free()
+
+# Reports the uncaught exceptions of a worker to the manager (ERROR) before aborting, so that rank 0 logs which rank
+# failed, on which job (messenger.job, set by the worker), and why. The worker aborts as soon as rank 0 acknowledges
+# the ERROR (ACK), once it has been logged, or after grace_time seconds without an answer.
+def report_errors(messenger, dest=0, grace_time=10):
+    def except_hook(exctype, value, traceback):
+        try:
+            from traceback import format_exception
+            text = ''.join(format_exception(exctype, value, traceback))
+            subSim, proj = messenger.job
+            start = time.time()
+            messenger.send(signals.ERROR, dest, subSim=subSim, proj=proj, text=text[-message_dtypes[signals.ERROR]['text'].itemsize:])
+            if messenger.flush(timeout=grace_time):
+                messenger.wait_for(signals.ACK, dest, grace_time-(time.time()-start))
+        finally:
+            global_except_hook(exctype, value, traceback)
+    sys.excepthook = except_hook
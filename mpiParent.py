@@ -18,14 +18,20 @@
 
 
 from mpi4py import MPI
-import sys, os, shutil, time, stat, pathlib
+import sys, os, shutil, time, stat, pathlib, tempfile
 from pathlib import Path
 import socket, time, argparse
 from utils import *
 import split_job
 import numpy as np
-from collectorManager import collectorManager, collectState
-from split_job import get_processCT_info_from_macfile, get_processed_macfile 
+from collectorManager import collectorManager, collectState, read_checkpoint, adaptive_splits, noise_stopping
+from split_job import get_processCT_info_from_macfile, get_processed_macfile, macfile_template
+from imageio import stack_images
+from gate_session import gate_session
+from manifest import manifest
+from logger import setup_logging, get_log, shutdown_logging
+from perf import job_timer, perf_recorder
+from messaging import messenger, report_errors, max_images
 
 
 queue_size = 10 # Tells the worker how many projections should have in memory while performing the reading tasks
@@ -103,19 +109,163 @@ def deleteOutputFolders(mac_file):
         #shutil.rmtree(parent_folder, onerror=rm_dir_readonly) if os.path.exists(parent_folder) else None
         remove_files_and_subfolders(parent_folder)
 
+# Reads the output images of a job into memory and deletes the files
+def read_output_images(output_files):
+    images = []
+    for output_file in output_files:
+        images.append(stack_images(output_file).get_stack()[0])
+        os.remove(output_file)
+    return images
+
+# Sums the images of all the ranks of subcomm on its rank 0 (the group leader), which gets the reduced images and the
+# dtypes of the outputs (see utils.image_dtypes) back. The sums are kept in double precision: the collector converts 
+# them to the type of the outputs when writing. A rank whose job has failed (images=None) contributes zeros, shaped as
+# the images of the other ranks; if the job has failed on all the ranks, there is nothing to reduce.
+def reduce_images(subcomm, images):
+    layouts = subcomm.allgather([(image.shape, get_image_dtype_code(image.dtype)) for image in images] if images is not None else None)
+    layout = next((layout for layout in layouts if layout is not None), [])
+    reduced = []
+    for i, (shape, _) in enumerate(layout):
+        image = images[i].astype(np.float64) if images is not None else np.zeros(shape, dtype=np.float64)
+        summed = np.zeros(shape, dtype=np.float64) if subcomm.Get_rank() == 0 else None
+        subcomm.Reduce(image, summed, op=MPI.SUM, root=0)
+        reduced.append(summed)
+    return reduced, [code for _, code in layout]
+
+# Returns the end of the log of a job, which is sent to rank 0 when the job fails
+def read_log_tail(log_file, size=1000):
+    if not os.path.exists(log_file):
+        return ''
+    with open(log_file, 'rb') as f:
+        f.seek(max(os.path.getsize(log_file)-size, 0))
+        return f.read().decode(errors='replace')
+
+# Renders the macfiles of all the jobs before the simulations start, split among all the ranks (rank 0 included). 
+# The folder is named after the hash of the template: when it is complete, the macfiles are not rendered again.
+def prepare_macfiles(comm, template, macfiles_assignment, macfileFolder):
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    complete_flag = os.path.join(macfileFolder, '.complete')
+    is_complete = os.path.exists(complete_flag) if rank == 0 else None
+    is_complete = comm.bcast(is_complete, root=0)
+    if is_complete:
+        return
+    cnt = 0
+    for p in range(len(macfiles_assignment[0])):
+        for s in range(len(macfiles_assignment)):
+            if cnt%size == rank:
+                template.render(macfiles_assignment[s][p], p, s)
+            cnt+=1
+    comm.Barrier()
+    if rank == 0:
+        open(complete_flag, 'w').close()
+
+# Generator used by the workers when the dynamic scheduler is active. The worker asks rank 0 for a job, and,
+# after every DONE signal it sends, it waits for the next job (or for a CLOSE signal, when the queue is empty).
+# The number of jobs each projection has been split into is stored in splits, the attempt of each job in attempts.
+def request_jobs(messages, rank, macfiles_assignment, splits, attempts):
+    messages.send(signals.REQUEST, 0, subSim=-1, proj=-1)
+    while True:
+        signal, _, record = messages.recv(source=0)
+        if signal == signals.CLOSE:
+            return
+        elif signal != signals.WORK:
+            raise Exception(getTimeString()+": rank "+str(rank)+" received unknown signal "+signal.name+" from the manager")
+        subSim, proj = int(record['subSim']), int(record['proj'])
+        splits[proj] = int(record['n_splits'])
+        attempts[(subSim, proj)] = int(record['attempt'])
+        yield macfiles_assignment[subSim][proj]
 
 '''
+    The options are keyword-only and named after the command line flags, e.g. main(macfile_path, scheduler='dynamic').
     Temporary macfiles are held in a ".tmp" folder in the job folder.
+    With scheduler='static' every rank gets its list of jobs up front (round-robin), with scheduler='dynamic'
+    the workers pull their next job from rank 0 as soon as they are done with the previous one.
+    With transfer='mpi' the outputs of the jobs are written in local_dir (node-local storage) and sent to rank 0 
+    over MPI, instead of going through the shared filesystem.
+    With reduction='tree' the workers are split into groups of nSubSims ranks, each group working on the subSims of 
+    one projection at a time. The outputs of a group are summed with MPI_Reduce and only the group leader sends the 
+    reduced images to rank 0 (outputs are always transferred over MPI in this mode).
+    With prepare=True, all the macfiles are rendered by all the ranks before the simulations start, in a folder of 
+    ".tmp" named after the hash of the macfile. They are kept, and a re-run with an unchanged macfile reuses them (it
+    draws the seeds of the previous run, recorded in the manifest).
+    The manager saves a checkpoint (".tmp/<jobName>/checkpoint.npz") after each merged projection and every 
+    checkpoint_interval seconds. With resume=True, the outputs and the temporary folder are not deleted and only the 
+    jobs missing from the checkpoint are executed.
+    With persistent_gate=True, every worker keeps one Gate application alive and streams the commands of each job to
+    it, instead of launching Gate (and initializing physics and geometry) for every job.
+    With topup=True, the run adds statistics to the outputs of the previous (completed) runs recorded in the manifest:
+    its jobs draw new seeds and the merged outputs are added to the existing ones.
+    With noise_target (dynamic scheduler only), the jobs of a projection which have not been handed out yet are 
+    cancelled once the relative noise of the subSims read so far (at least noise_min_subsims), in the noise_roi region
+    (x0, x1, y0, y1) of the first output, reaches the target. The other jobs of a projection wait for its first 
+    noise_min_subsims ones to be read. The merged output is rescaled to nProcesses subSims.
+    With output_backend='npy', the merged projections of each output are written in place, by index, in a single 
+    memory-mapped (nProjs, ny, nx) volume (a .npy file), instead of one image file per projection. With 'hdf5', all the 
+    outputs go to a single compressed HDF5 file, one dataset per output, with the metadata of the projections.
+    The logs of all the ranks ('.logs/<jobName>') are written by a background thread and flushed every 
+    log_flush_interval seconds; log_level='debug' adds the state changes and the messages of every job, and 
+    log_format='json' writes JSON lines instead of text.
+    With perf=True, the workers time the steps of every job and send them to the manager with the DONE signal; rank 0
+    writes a performance report (<jobName>.perf.txt) and a Chrome/Perfetto timeline (<jobName>.trace.json).
+    With adaptive=True (dynamic scheduler only), the number of jobs of each projection is chosen by the manager from 
+    the measured runtimes, between min_subsims and max_subsims, and the primaries of nProcesses runs are split among 
+    them.
+    A job whose Gate run fails (non-zero return code) is run again with a fresh seed, up to max_retries times: by the
+    same worker with the static scheduler, by another worker (if any is available) with the dynamic one. The jobs 
+    which still fail are recorded in the manifest and the scan goes on without them: with failed_projections='rescale'
+    their projections are rescaled to the primaries of all their jobs, with 'flag' they are written as they are. With
+    the tree reduction, a rank whose job still fails contributes zeros to the sum of its group, and the group leader 
+    reports the failure before the reduced images.
 '''
-def main(macfile_path, is_test=False, keep_macfile=False, keep_logs=False):
-    nProjs, nSubSims = get_processCT_info_from_macfile(macfile_path)
-
+def main(macfile_path, *, is_test=False, keep_macfile=False, keep_logs=False, scheduler='static', transfer='file', local_dir=None, reduction='collector', reader_threads=1, writer_threads=2, resolve_includes=True, prepare=False, resume=False, checkpoint_interval=60, persistent_gate=False, 
+         adaptive=False, min_subsims=1, max_subsims=None, topup=False, noise_target=None, noise_roi=None, noise_min_subsims=4, output_backend='itk', 
+         log_level='info', log_format='text', log_flush_interval=1., perf=False, max_retries=2, failed_projections='rescale'):
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     size = comm.Get_size()
-    
+    messages = messenger(comm) # signals between the manager and the workers
+
+    if adaptive:
+        assert scheduler == 'dynamic' and reduction == 'collector', 'The adaptive splitting works with the dynamic scheduler and the collector reduction only'
+        assert not prepare, 'The macfiles cannot be prepared with the adaptive splitting, which chooses the jobs at run time'
+    if noise_target is not None:
+        assert scheduler == 'dynamic' and reduction == 'collector' and not adaptive, 'The early stopping works with the dynamic scheduler, the collector reduction and a fixed number of subSims only'
+
     jobFolder = os.path.dirname(os.path.abspath(macfile_path))
     jobName = os.path.splitext(os.path.abspath(macfile_path))[0].split('/')[-1]
+
+    # The macfile is parsed once, on rank 0, and the template is broadcast to the other ranks. A resumed run draws
+    # the same seeds as the interrupted one, which are recorded in the run manifest; a top-up run is added to the 
+    # manifest with the next run index (i.e. new seeds); a new run starts a new manifest.
+    if rank == 0:
+        run_manifest = manifest(os.path.join(jobFolder, jobName+'.manifest.json'))
+        last_run = run_manifest.last_run() if (resume or topup) else None
+        if resume and last_run is not None:
+            template = macfile_template(macfile_path, resolve_includes, adaptive, max_subsims, last_run['master_seed'], last_run['run_index'])
+            topup = last_run['run_index'] > 0 # an interrupted top-up is resumed as such
+        elif topup:
+            if last_run is None or last_run['completed'] is None:
+                raise Exception('A top-up run needs the previous runs to be completed (see '+run_manifest.path+'): resume the last one first')
+            template = macfile_template(macfile_path, resolve_includes, adaptive, max_subsims, last_run['master_seed'], last_run['run_index']+1)
+            if template.get_n_projs() != run_manifest.content['n_projs']:
+                raise Exception('A top-up run must simulate the same '+str(run_manifest.content['n_projs'])+' projections as the previous runs')
+            run_manifest.add_run(template, macfile_path)
+        else:
+            template = macfile_template(macfile_path, resolve_includes, adaptive, max_subsims)
+            first_run = run_manifest.runs[0] if len(run_manifest.runs) > 0 else None
+            if prepare and first_run is not None and first_run.get('macfile_hash') == template.macfile_hash:
+                # the seeds of the previous scan of the same macfile are drawn again, so that its prepared macfiles are reused
+                template = macfile_template(macfile_path, resolve_includes, adaptive, max_subsims, first_run['master_seed'])
+            run_manifest.clear()
+            run_manifest.add_run(template, macfile_path)
+    else:
+        template = None
+    template = comm.bcast(template, root=0)
+    nProjs, nSubSims = template.get_n_projs(), template.get_n_processes()
+    if adaptive: # there is a row of jobs for each of the max_subsims jobs a projection can be split into
+        nSubSims = template.max_splits
+    
     logFolder = os.path.join(jobFolder, ".logs", jobName)
     pathlib.Path(logFolder).mkdir(parents=True, exist_ok=True)
     if (rank == 0) and (not os.path.exists(logFolder)):
@@ -125,74 +275,209 @@ def main(macfile_path, is_test=False, keep_macfile=False, keep_logs=False):
     comm.Barrier()
     start_time = time.time()
 
-    logfile = open(os.path.join(logFolder,'master-' +str(rank) +'.log'), 'w') 
-    logfile.write(getTimeString() +": Starting MPI job rank "+str(rank) +" of "+str(size)+". On: "+socket.gethostname()+"\n")
-    logfile.flush()
+    setup_logging(log_level, log_format, log_flush_interval, rank)
+    log = get_log('master', os.path.join(logFolder,'master-' +str(rank) +'.log'))
+    log.info("Starting MPI job rank %d of %d. On: %s", rank, size, socket.gethostname())
 
     if rank == 0:
         cstate = collectState(logFolder, nSubSims, nProjs)    
 
+    if reduction == 'tree':
+        assert scheduler == 'static', 'The tree reduction works with the static scheduler only'
+        nGroups = (size-1)//nSubSims
+        if nGroups == 0:
+            raise Exception('The tree reduction needs at least nProcesses+1 = '+str(nSubSims+1)+' ranks, only '+str(size)+' are available')
+        transfer = 'mpi'
+        # ranks which do not fit in a complete group (and rank 0) do not take part in any reduction
+        group = (rank-1)//nSubSims if (rank != 0) and ((rank-1)//nSubSims < nGroups) else MPI.UNDEFINED
+        subcomm = comm.Split(group, rank)
+
     tmpFolder = os.path.join(jobFolder, ".tmp", jobName)
-    if rank == 0:
-        # delete temporary folder with macfiles
-        shutil.rmtree(tmpFolder, onerror=rm_dir_readonly) if os.path.exists(tmpFolder) else None
-        pathlib.Path(tmpFolder).mkdir(parents=True, exist_ok=True)
-        # delete output folder with outputs (!!!)
-        deleteOutputFolders(macfile_path)
+    macfileFolder = os.path.join(tmpFolder, template.hash) if prepare else tmpFolder
+    if transfer == 'mpi' and rank != 0:
+        localFolder = os.path.join(local_dir if local_dir is not None else tempfile.gettempdir(), "mpiForGate", jobName, str(rank))
+        pathlib.Path(localFolder).mkdir(parents=True, exist_ok=True)
+    retryFolder = os.path.join(macfileFolder, 'retry') # macfiles of the retries, when the prepared ones are kept
+    checkpoint_path = os.path.join(tmpFolder, 'checkpoint.npz')
+    topup_dir = os.path.join(tmpFolder, 'topup') # merged outputs of the previous runs, until the top-up is completed
+    done = np.zeros((nSubSims, nProjs), dtype=bool) # jobs completed by a previous run
+    partial, merged = {}, {}
+    if rank == 0 and resume:
+        if os.path.exists(checkpoint_path):
+            done, partial, merged = read_checkpoint(checkpoint_path, template.hash)
+            # the groups reduce all the subSims of a projection at once, the split and the scale of the output may differ
+            if reduction == 'tree' or adaptive or noise_target is not None:
+                for proj in partial:
+                    done[:,proj] = False
+                partial = {}
+            cstate.restore(done)
+            log.info('resuming from %s, %d jobs out of %d already done', checkpoint_path, np.sum(done), done.size)
+        else:
+            log.info('no checkpoint to resume from in %s', checkpoint_path)
+        pathlib.Path(macfileFolder).mkdir(parents=True, exist_ok=True)
+    elif rank == 0:
+        # delete temporary folder with macfiles (but the ones prepared for the same macfile)
+        if prepare and os.path.exists(tmpFolder):
+            for entry in os.listdir(tmpFolder):
+                if entry != template.hash:
+                    entry = os.path.join(tmpFolder, entry)
+                    shutil.rmtree(entry, onerror=rm_dir_readonly) if os.path.isdir(entry) else os.remove(entry)
+        else:
+            shutil.rmtree(tmpFolder, onerror=rm_dir_readonly) if os.path.exists(tmpFolder) else None
+        pathlib.Path(macfileFolder).mkdir(parents=True, exist_ok=True)
+        # delete output folder with outputs (!!!), unless they are topped up
+        deleteOutputFolders(macfile_path) if not topup else None
     
-    # At this point, the temporary folder should exist and be empty
-    comm.Barrier() 
+    # At this point, the temporary folder should exist and be empty (unless resuming)
+    done = comm.bcast(done, root=0)
             
     macfiles_assignment = [[None for i in range(nProjs)] for j in range(nSubSims)]
     for p in range(nProjs):
         for s in range(nSubSims):
             # It creates the paths to the mac/batch files which will be created and executed later on
-            file_to_execute = os.path.join(tmpFolder, jobName +'_' +str(p) +'_' +str(s) +'.mac')
+            file_to_execute = os.path.join(macfileFolder, jobName +'_' +str(p) +'_' +str(s) +'.mac')
             macfiles_assignment[s][p] = file_to_execute
+
+    if prepare:
+        prepare_macfiles(comm, template, macfiles_assignment, macfileFolder)
         
     # Every rank has its "files_to_execute"
     files_to_execute = []
     cnt=0
     for p in range(nProjs):       
         for s in range(nSubSims):
-            assigned_to_rank = cnt%(size-1)+1
+            if done[s,p]:
+                continue
+            if scheduler == 'dynamic': # jobs are queued in projection order and handed out on request
+                if rank == 0:
+                    cstate.assign(macfiles_assignment[s][p], -1,s,p)
+                    cstate.add_pending(s,p)
+                continue
+            if reduction == 'tree': # every group works on the same projection, each of its ranks on a different subSim
+                assigned_to_rank = 1 + (p%nGroups)*nSubSims + s
+            else:
+                assigned_to_rank = cnt%(size-1)+1
             if assigned_to_rank == rank:
                 files_to_execute.append(macfiles_assignment[s][p])
             if rank == 0:
                 cstate.assign(macfiles_assignment[s][p], assigned_to_rank,s,p)
             cnt+=1
 
-    if rank == 1:
+    if rank == 1 and scheduler == 'static' and not np.any(done):
         assert len(files_to_execute)!=0, 'Something went wrong..'
 
     if rank == 0: # The first rank do not execute any external code, just manage the collector
-        logfile.write(getTimeString() +': launching collector manager..' +"\n")
-        logfile.flush()
-        cm = collectorManager(logFolder, cstate, queue_size, keep_macfile)
-        logfile.write(getTimeString() +': joining..' +"\n")
-        logfile.flush()
+        log.info('launching collector manager..')
+        recorder = perf_recorder() if perf else None
+        # the prepared macfiles are kept for the next runs
+        cm = collectorManager(logFolder, cstate, queue_size, keep_macfile=keep_macfile or prepare, scheduler=scheduler, is_test=is_test, 
+                              transfer=transfer, reduction=reduction, n_readers=reader_threads, n_writers=writer_threads, 
+                              checkpoint_path=checkpoint_path, checkpoint_hash=template.hash, checkpoint_interval=checkpoint_interval, 
+                              partial=partial, merged=merged, 
+                              adaptive=adaptive_splits(template.get_n_processes(), min(min_subsims, nSubSims), nSubSims) if adaptive else None, 
+                              topup_dir=topup_dir if topup else None, 
+                              base_primaries=run_manifest.get_base_primaries(nProjs) if topup else None, 
+                              noise=noise_stopping(noise_target, max(noise_min_subsims, 2), noise_roi if noise_roi is not None else (None,)*4) if noise_target is not None else None, 
+                              output_backend=output_backend, get_metadata=template.get_projection_metadata, perf=recorder, messages=messages,
+                              max_retries=max_retries, failed_projections=failed_projections, job_primaries=template.get_job_primaries)
+        log.info('joining..')
         cm.join()
+        failures, n_recovered = cm.get_failures()
+        if len(failures) > 0 or n_recovered > 0:
+            run_manifest.record_failures(failures, n_recovered, failed_projections)
+            log.warning('%d jobs failed (%d recovered by a retry), see %s', len(failures), n_recovered, run_manifest.path)
+        if recorder is not None:
+            recorder.finish()
+            report_path, trace_path = os.path.join(jobFolder, jobName+'.perf.txt'), os.path.join(jobFolder, jobName+'.trace.json')
+            recorder.write(report_path, trace_path)
+            log.info('performance report written in %s, timeline in %s', report_path, trace_path)
+        run_manifest.record_projection_primaries(*cm.get_projection_primaries())
+        run_manifest.complete_run()
+        shutil.rmtree(topup_dir, onerror=rm_dir_readonly) if os.path.exists(topup_dir) else None
     else:
+        splits, attempts = {}, {}
+        if scheduler == 'dynamic':
+            files_to_execute = request_jobs(messages, rank, macfiles_assignment, splits, attempts)
+        session = gate_session(template) if persistent_gate and not is_test else None
+        report_errors(messages) # an uncaught exception is reported to rank 0 before aborting
+        wait_start = time.time()
         for file_to_execute in files_to_execute:
+            timer = job_timer()
+            timer.set('wait', wait_start, time.time())
             subSim, proj = getSimulationParametersFromPath(file_to_execute)
+            messages.job = (subSim, proj)
             batch_log_file = os.path.join(logFolder,'job-'+str(proj)+'-'+str(subSim)+'.log')
-            split_job.get_processed_macfile(macfile_path, file_to_execute, proj, subSim)
-            createOutputFolders(file_to_execute)
-            logfile.write(getTimeString() +': rank ' +str(rank) +' has started file '+file_to_execute+'\n')
-            logfile.flush()  
-            rc = os.system('Gate '+file_to_execute + ' > '+batch_log_file) if not is_test else simulateGate(file_to_execute)
-            if rc != 0:
-                raise Exception('Process '+str(rank)+' returned a non-zero value. Its arguments were: '+file_to_execute+' and the log file was '+batch_log_file)
-            logfile.write(getTimeString() +': rank ' +str(rank) +' has finished file '+file_to_execute+'\n')
-            logfile.flush()  
-            data = np.array([signals.DONE.value, rank, subSim, proj], dtype=np.int32)
-            comm.Send([data,MPI.INT], dest=0)
+            attempt = attempts.pop((subSim, proj), 0)
+            while True:
+                # the prepared macfiles are kept for the next runs: a retry (new seed) is rendered aside
+                job_macfile = file_to_execute if not (prepare and attempt > 0) else os.path.join(retryFolder, os.path.basename(file_to_execute))
+                pathlib.Path(retryFolder).mkdir(exist_ok=True) if job_macfile != file_to_execute else None
+                with timer.span('render'):
+                    template.render(job_macfile, proj, subSim, splits.get(proj) if adaptive else None, attempt) if (not prepare or attempt > 0) else None
+                with timer.span('folders'):
+                    createOutputFolders(file_to_execute)
+                gate_macfile = job_macfile
+                if transfer == 'mpi': # Gate runs on a copy of the macfile which writes its outputs in the local folder
+                    gate_macfile = os.path.join(localFolder, os.path.basename(file_to_execute))
+                    local_output_files = split_job.localize_macfile(job_macfile, gate_macfile, localFolder)
+                    createOutputFolders(gate_macfile)
+                log.info('rank %d has started file %s', rank, job_macfile, extra={'fields': {'proj': proj, 'subSim': subSim}})
+                with timer.span('gate'):
+                    if is_test:
+                        rc = simulateGate(gate_macfile)
+                    elif session is not None:
+                        rc = session.run(gate_macfile, batch_log_file)
+                    else:
+                        rc = os.system('Gate '+gate_macfile + ' > '+batch_log_file)
+                removeOutputFiles(gate_macfile) if rc != 0 else None # the outputs of a failed run are not merged
+                os.remove(job_macfile) if job_macfile != file_to_execute else None
+                if rc == 0:
+                    break
+                # the static workers retry the job themselves, the dynamic ones leave it to the manager
+                final = (scheduler == 'dynamic') or (attempt >= max_retries)
+                log.warning('rank %d: file %s returned %d (attempt %d), the log file was %s', rank, gate_macfile, rc, attempt, batch_log_file)
+                failure = dict(subSim=subSim, proj=proj, rank=rank, attempt=attempt, rc=rc, final=final, 
+                               text=read_log_tail(batch_log_file).encode()[-1000:])
+                if reduction == 'tree' and final: # reported by the group leader, before the reduced images
+                    break
+                messages.send(signals.FAILED, 0, **failure)
+                if final:
+                    break
+                attempt += 1
+            if rc != 0 and reduction != 'tree':
+                os.remove(gate_macfile) if transfer == 'mpi' and not keep_macfile else None
+                wait_start = time.time()
+                messages.job = (-1, -1)
+                continue
+            if rc == 0:
+                log.info('rank %d has finished file %s', rank, file_to_execute, extra={'fields': {'proj': proj, 'subSim': subSim}})
+            if transfer == 'mpi':
+                with timer.span('read'):
+                    images = read_output_images(local_output_files) if rc == 0 else None
+                os.remove(gate_macfile) if not keep_macfile else None
+            if reduction == 'tree':
+                images, out_dtypes = reduce_images(subcomm, images)
+                failures = subcomm.gather(failure if rc != 0 else None, root=0)
+                if subcomm.Get_rank() == 0: # the leader sends the reduced images in place of the whole group
+                    for failure in failures: # the failed jobs are known to rank 0 when the images arrive
+                        messages.send(signals.FAILED, 0, **failure) if failure is not None else None
+                    messages.send(signals.REDUCED, 0, images, subSim=0, proj=proj, n_subsims=nSubSims, timing=timer.to_array(),
+                                  out_dtype=out_dtypes+[0]*(max_images-len(out_dtypes)))
+                os.remove(batch_log_file) if not keep_logs and rc == 0 else None
+                wait_start = time.time()
+                continue
+            messages.send(signals.DONE, 0, images if transfer == 'mpi' else (), subSim=subSim, proj=proj, timing=timer.to_array())
             os.remove(batch_log_file) if not keep_logs else None
+            wait_start = time.time()
+            messages.job = (-1, -1)
+        if session is not None:
+            session.close()
   
     print("Rank "+str(rank)+" of " +str(size) +": Exiting without errors")
 
+    messages.free()
+    shutdown_logging() # the logs are complete before rank 0 deletes them
     comm.Barrier()
-    logfile.close()
     if rank == 0:
         print('Total time in hh:mm:ss: ', time.strftime("%H:%M:%S", time.gmtime(time.time()-start_time)))
     if rank == 0 and not keep_logs:
@@ -203,8 +488,33 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--macfile', dest='macfile_path', required=True)
     parser.add_argument('--test', dest='is_test', action=argparse.BooleanOptionalAction, default=False)
-    parser.add_argument('--keep_macfiles', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--keep_macfiles', dest='keep_macfile', action=argparse.BooleanOptionalAction, default=False)
     parser.add_argument('--keep_logs', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--scheduler', choices=['static', 'dynamic'], default='static')
+    parser.add_argument('--transfer', choices=['file', 'mpi'], default='file')
+    parser.add_argument('--local_dir', default=None)
+    parser.add_argument('--reduction', choices=['collector', 'tree'], default='collector')
+    parser.add_argument('--reader_threads', type=int, default=1)
+    parser.add_argument('--writer_threads', type=int, default=2)
+    parser.add_argument('--resolve_includes', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--prepare', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--checkpoint_interval', type=float, default=60)
+    parser.add_argument('--persistent_gate', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--adaptive', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--min_subsims', type=int, default=1)
+    parser.add_argument('--max_subsims', type=int, default=None)
+    parser.add_argument('--topup', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--noise_target', type=float, default=None)
+    parser.add_argument('--noise_roi', type=int, nargs=4, metavar=('X0', 'X1', 'Y0', 'Y1'), default=None)
+    parser.add_argument('--noise_min_subsims', type=int, default=4)
+    parser.add_argument('--output_backend', type=str, default='itk', choices=['itk', 'npy', 'hdf5'])
+    parser.add_argument('--log_level', choices=['debug', 'info', 'warning', 'error'], default='info')
+    parser.add_argument('--log_format', choices=['text', 'json'], default='text')
+    parser.add_argument('--log_flush_interval', type=float, default=1.)
+    parser.add_argument('--perf', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--max_retries', type=int, default=2)
+    parser.add_argument('--failed_projections', choices=['rescale', 'flag'], default='rescale')
     args = parser.parse_args()
     
-    main(args.macfile_path, args.is_test, args.keep_macfiles, args.keep_logs)
\ No newline at end of file
+    main(**vars(args))
@@ -0,0 +1,202 @@
+
+# 
+# This file is part of the nn_3D-anomaly-detection distribution (https://github.com/mpiForGate/mpiForGate).
+# Copyright (c) 2022-2023 imec-Vision Lab, University of Antwerp.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json, sys, time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, current_thread
+import numpy as np
+from utils import *
+
+__all__ = ['worker_spans', 'job_timer', 'perf_recorder']
+sys.excepthook = global_except_hook
+
+# Performance instrumentation (--perf). Every worker times the steps of its jobs and sends them to the manager after 
+# the DONE signal (its timing field); the manager times its own steps (reads, sums, writes, merges), and rank 0 writes a 
+# report and a timeline which can be opened with chrome://tracing or https://ui.perfetto.dev. Times are wall-clock 
+# times (time.time()), the clocks of the nodes are assumed to be synchronized.
+
+# The steps of a job on a worker: waiting for the job (dynamic scheduler), rendering its macfile, creating its output
+# folders, running Gate and reading its outputs (MPI transfer)
+worker_spans = ('wait', 'render', 'folders', 'gate', 'read')
+
+class job_timer:
+    def __init__(self):
+        self.times = np.full((len(worker_spans), 2), np.nan)
+
+    def set(self, name, start, end):
+        self.times[worker_spans.index(name)] = (start, end)
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.set(name, start, time.time())
+
+    # The payload sent after the DONE signal: (start, end) of every step, NaN for the steps which did not happen
+    def to_array(self):
+        return self.times.ravel()
+
+# Collects the timings of the run on rank 0. The spans of the workers come with the DONE signals (add_job); the 
+# spans of the manager threads (span) and the volumes read and written (count) are recorded by the manager and the
+# collector. The recorder is shared by the threads of the manager.
+class perf_recorder:
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.lock = Lock()
+        self.jobs = {} # (subSim, proj) -> {'rank', 'spans' (n_spans, 2), 'done': DONE received, 'read': read started}
+        self.spans = [] # (name, thread, start, end, args) of the manager
+        self.counters = defaultdict(float)
+        self.written = {} # proj -> time the merged projection has been written
+
+    def add_job(self, subSim, proj, rank, payload, done_time):
+        with self.lock:
+            self.jobs[(subSim, proj)] = {'rank': rank, 'spans': np.asarray(payload, dtype=np.float64).reshape(len(worker_spans), 2), 
+                                         'done': done_time, 'read': None}
+
+    def job_read(self, subSim, proj, read_time):
+        with self.lock:
+            if (subSim, proj) in self.jobs:
+                self.jobs[(subSim, proj)]['read'] = read_time
+
+    def projection_written(self, proj, write_time):
+        with self.lock:
+            self.written[proj] = write_time
+
+    def span(self, name, start, end, **args):
+        with self.lock:
+            self.spans.append((name, current_thread().name, start, end, args))
+
+    @contextmanager
+    def timed(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(name, start, time.time(), **args)
+
+    def count(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.counters[key] += value
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def get_worker_stats(self):
+        wall = (self.end_time if self.end_time is not None else time.time())-self.start_time
+        per_rank = defaultdict(lambda: np.zeros(len(worker_spans)))
+        n_jobs = defaultdict(int)
+        for job in self.jobs.values():
+            durations = job['spans'][:,1]-job['spans'][:,0]
+            per_rank[job['rank']] += np.nan_to_num(durations)
+            n_jobs[job['rank']] += 1
+        return wall, per_rank, n_jobs
+
+    # Per projection: first step of its jobs, end of its last job, DONE of its last job, read of its last job and write
+    # of the merged projection. The critical path of the projection goes through its last job.
+    def get_projection_paths(self):
+        last_jobs = {}
+        first_start = {}
+        for (subSim, proj), job in self.jobs.items():
+            start = np.nanmin(job['spans']) if not np.all(np.isnan(job['spans'])) else job['done']
+            first_start[proj] = min(first_start.get(proj, start), start)
+            if proj not in last_jobs or job['done'] > last_jobs[proj]['done']:
+                last_jobs[proj] = job
+        paths = {}
+        for proj, job in last_jobs.items():
+            if proj not in self.written:
+                continue
+            gate = job['spans'][worker_spans.index('gate')]
+            job_end = np.nanmax(job['spans']) if not np.all(np.isnan(job['spans'])) else job['done']
+            read = job['read'] if job['read'] is not None else job['done']
+            paths[proj] = {'total': self.written[proj]-first_start[proj], 'last_gate': np.nan_to_num(gate[1]-gate[0]), 
+                           'last_job': job_end-np.nanmin(job['spans']) if not np.all(np.isnan(job['spans'])) else 0., 
+                           'signal': job['done']-job_end, 'queue': read-job['done'], 'merge': self.written[proj]-read, 'rank': job['rank']}
+        return paths
+
+    def report(self):
+        wall, per_rank, n_jobs = self.get_worker_stats()
+        lines = ['Run: {:.3f} s wall time, {} jobs on {} workers, {} merged projections'.format(wall, len(self.jobs), len(per_rank), len(self.written))]
+        lines.append('')
+        lines.append('Workers (share of the wall time): ' + ', '.join(worker_spans) + ', idle')
+        for rank in sorted(per_rank):
+            shares = per_rank[rank]/wall
+            lines.append('  rank {:4d}: {:5d} jobs, utilisation (gate) {:6.1%} | '.format(rank, n_jobs[rank], shares[worker_spans.index('gate')]) +
+                         ' '.join('{:6.1%}'.format(share) for share in shares) + ' {:6.1%}'.format(max(1.-shares.sum(), 0.)))
+        if len(self.jobs) > 0:
+            durations = np.array([job['spans'][:,1]-job['spans'][:,0] for job in self.jobs.values()])
+            lines.append('Job steps (mean / max, s): ' + ', '.join('{} {:.3f} / {:.3f}'.format(name, np.nanmean(durations[:,i]), np.nanmax(durations[:,i])) 
+                                                                  for i, name in enumerate(worker_spans) if not np.all(np.isnan(durations[:,i]))))
+            ends = np.array([np.nanmax(job['spans']) if not np.all(np.isnan(job['spans'])) else job['done'] for job in self.jobs.values()])
+            dones = np.array([job['done'] for job in self.jobs.values()])
+            reads = np.array([job['read'] if job['read'] is not None else job['done'] for job in self.jobs.values()])
+            lines.append('Signal latency (end of job to DONE received, s): mean {:.4f}, max {:.4f}'.format(np.mean(dones-ends), np.max(dones-ends)))
+            lines.append('Queue wait (DONE received to read, s): mean {:.4f}, max {:.4f}'.format(np.mean(reads-dones), np.max(reads-dones)))
+        lines.append('')
+        c = self.counters
+        read_time = c['read_time']
+        lines.append('Collector: read {:.0f} images, {:.1f} MB in {:.3f} s ({:.1f} MB/s, {:.1f} images/s), of which {:.3f} s summing'.format(
+            c['images_read'], c['bytes_read']/1e6, read_time, c['bytes_read']/1e6/read_time if read_time > 0 else 0., 
+            c['images_read']/read_time if read_time > 0 else 0., c['sum_time']))
+        lines.append('           wrote {:.0f} images, {:.1f} MB in {:.3f} s ({:.1f} MB/s, {:.1f} images/s), hadd {:.3f} s'.format(
+            c['images_written'], c['bytes_written']/1e6, c['write_time'], c['bytes_written']/1e6/c['write_time'] if c['write_time'] > 0 else 0., 
+            c['images_written']/c['write_time'] if c['write_time'] > 0 else 0., c['hadd_time']))
+        lines.append('           operator idle {:.3f} s ({:.1%} of the wall time)'.format(c['operator_idle'], c['operator_idle']/wall if wall > 0 else 0.))
+        paths = self.get_projection_paths()
+        if len(paths) > 0:
+            lines.append('')
+            lines.append('Critical path of the projections (s): first job start to merged projection written, through its last job')
+            lines.append('  mean: total {:.3f}, last job {:.3f} (gate {:.3f}), signal {:.4f}, queue {:.4f}, merge {:.4f}'.format(
+                *[np.mean([path[key] for path in paths.values()]) for key in ['total', 'last_job', 'last_gate', 'signal', 'queue', 'merge']]))
+            for proj in sorted(paths, key=lambda proj: -paths[proj]['total'])[:10]:
+                path = paths[proj]
+                lines.append('  proj {:5d}: total {:.3f}, last job {:.3f} (gate {:.3f}, rank {}), signal {:.4f}, queue {:.4f}, merge {:.4f}'.format(
+                    proj, path['total'], path['last_job'], path['last_gate'], path['rank'], path['signal'], path['queue'], path['merge']))
+        return '\n'.join(lines)+'\n'
+
+    # Chrome trace format (complete events, in microseconds from the start of the run): a process per rank, the 
+    # threads of rank 0 (operator, listener, writers) as its threads
+    def trace(self):
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': 0, 'args': {'name': 'rank 0 (manager)'}}]
+        tids = {'listener': 1} # thread name -> tid on rank 0
+        us = lambda t: (t-self.start_time)*1e6
+        for (subSim, proj), job in self.jobs.items():
+            for i, name in enumerate(worker_spans):
+                start, end = job['spans'][i]
+                if not np.isnan(start):
+                    events.append({'ph': 'X', 'name': name, 'cat': 'worker', 'pid': job['rank'], 'tid': 0, 'ts': us(start), 
+                                   'dur': (end-start)*1e6, 'args': {'proj': proj, 'subSim': subSim}})
+            events.append({'ph': 'i', 's': 't', 'name': 'DONE', 'cat': 'manager', 'pid': 0, 'tid': tids['listener'], 'ts': us(job['done']), 
+                           'args': {'proj': proj, 'subSim': subSim, 'rank': job['rank']}})
+        for rank in {job['rank'] for job in self.jobs.values()}:
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': rank, 'args': {'name': 'rank {}'.format(rank)}})
+        for name, thread, start, end, args in self.spans:
+            tid = tids.setdefault(thread, len(tids)+1)
+            events.append({'ph': 'X', 'name': name, 'cat': 'manager', 'pid': 0, 'tid': tid, 'ts': us(start), 'dur': (end-start)*1e6, 'args': args})
+        for thread, tid in tids.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': 0, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, report_path, trace_path):
+        with open(report_path, 'w') as f:
+            f.write(self.report())
+        with open(trace_path, 'w') as f:
+            json.dump(self.trace(), f, default=float)
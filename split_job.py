@@ -15,8 +15,8 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-from macfile import macfile as mf
-import copy, numpy as np, os, pathlib, sys
+from macfile import macfile as mf, format_line
+import copy, numpy as np, os, pathlib, sys, hashlib
 from scipy.spatial.transform import Rotation as R
 from enum import Enum
 from utils import *
@@ -66,6 +66,7 @@ class proj_par_manager:
     def __init__(self, mac_dict):
         super().__init__()
         self._scan_type = ScanType.Radiograph
+        self.geometry = None
         self.load_useful_values(mac_dict)
         
     @property
@@ -117,6 +118,7 @@ class proj_par_manager:
         else:
             self.init_rot_axis  = np.array([0.,0.,1.],dtype=np.float32)
             self.init_rot_angle = np.array(0.,dtype=np.float32)
+        self.compute_geometry()
     
     def load_useful_values_energy_swipe(self, mac_dict):
         energies_string = mac_dict.pop('/mpiForGate/energySwipe', None) # this is a list of 4 elements: start_energy, end_energy, energy metric, step (default 1)
@@ -158,30 +160,34 @@ class proj_par_manager:
         else:
             self.outfile, self.scatter_outfile, self.rootoutfile = None, None, None
 
-    def rotate(self, angle_n):
-        r = R.from_euler(self.rot_axis_lett, self.projs[angle_n], degrees=True) ### unit
-        rot_matrix = r.as_matrix()
+    # Computes the geometry of all the projections at once: source position, detector position, detector rotation 
+    # (axis and angle, composed with the initial rotation given in the macfile) and the source plane axes rot1/rot2.
+    # The resulting table is computed once (e.g. when the macfile template is built) and reused by every job.
+    def compute_geometry(self):
+        rot_matrices = R.from_euler(self.rot_axis_lett, self.projs[:,np.newaxis], degrees=True).as_matrix() ### unit
         # Source position and orientation
-        src_pos = np.matmul(rot_matrix,self.src_pos-self.COR_axis)+self.COR_axis
-        if self.rot_axis_lett == 'z':
-            posrot1 = rot_matrix[:,1]
-            posrot2 = rot_matrix[:,2]
-        else:
-            raise NotImplementedError
+        src_pos = np.einsum('nij,j->ni', rot_matrices, self.src_pos-self.COR_axis)+self.COR_axis
+        posrot1 = rot_matrices[:,:,1]
+        posrot2 = rot_matrices[:,:,2]
         # Detector position and orientation
-        det_pos = np.matmul(rot_matrix,self.det_pos-self.COR_axis)+self.COR_axis
+        det_pos = np.einsum('nij,j->ni', rot_matrices, self.det_pos-self.COR_axis)+self.COR_axis
         # Now, we have to concatenate the actual rotation found above with the initial rotation. The initial rotation is given by the user in the mac file.
         initial_rot_matrix = R.from_rotvec(self.init_rot_angle*self.init_rot_axis, degrees=True).as_matrix()
-        total_rot_matrix = np.matmul(rot_matrix, initial_rot_matrix)
-        rot_axis  = R.from_matrix(total_rot_matrix).as_rotvec(degrees=True)
-        if np.linalg.norm(rot_axis) == 0.: # no rotation
-            rot_axis  = self.rot_axis
-            rot_angle = 0.
-        else: # rotation has to be decomposed from a single axis notation to (angle, axis) notation
-            rot_angle = np.linalg.norm(rot_axis)
-            rot_axis /= rot_angle
-        
-        return src_pos, rot_axis, rot_angle, det_pos, posrot1, posrot2
+        total_rot_matrices = np.matmul(rot_matrices, initial_rot_matrix)
+        rot_axes   = R.from_matrix(total_rot_matrices).as_rotvec(degrees=True)
+        rot_angles = np.linalg.norm(rot_axes, axis=1)
+        no_rotation = rot_angles == 0.
+        # rotations have to be decomposed from a single axis notation to (angle, axis) notation
+        rot_axes[no_rotation]  = self.rot_axis
+        rot_axes[~no_rotation] /= rot_angles[~no_rotation,np.newaxis]
+        self.geometry = {'src_pos': src_pos, 'rot_axis': rot_axes, 'rot_angle': rot_angles, 'det_pos': det_pos, 
+                         'posrot1': posrot1, 'posrot2': posrot2}
+
+    def rotate(self, angle_n):
+        if self.geometry is None:
+            self.compute_geometry()
+        g = self.geometry
+        return g['src_pos'][angle_n], g['rot_axis'][angle_n], g['rot_angle'][angle_n], g['det_pos'][angle_n], g['posrot1'][angle_n], g['posrot2'][angle_n]
     
     def build_output_paths(self, path, proj_n):
         outfile         = insert_number_as_parent(self.outfile,         proj_n) if (self.outfile         is not None) else None
@@ -261,34 +267,194 @@ class cpu_par_manager:
             values.append([rootoutfile])
         return commands, values
 
-class seed_par_manager:
+class primaries_par_manager:
     def __init__(self, mac_dict):
-        pass
+        n_primaries = mac_dict.get('/gate/application/setNumberOfPrimariesPerRun')
+        self.n_primaries = int(float(n_primaries[0])) if n_primaries is not None else None
+
+    # The primaries of n_processes runs are split into n_splits runs, whose numbers of primaries differ by one at most
+    def get_task_per_param(self, cpu_n, n_processes, n_splits):
+        total = self.n_primaries*n_processes
+        n_primaries = total//n_splits + (1 if cpu_n < total%n_splits else 0)
+        commands, values = [], []
+        commands.append('/gate/application/setNumberOfPrimariesPerRun')
+        values.append([n_primaries])
+        return commands, values
+
+# Every job gets its own seed. The seeds are drawn from a SeedSequence specific to the run: it is spawned from a master 
+# seed (given by /mpiForGate/masterSeed, or by the run manifest when resuming, or else fresh entropy) with the index 
+# of the run as spawn key, so that the runs which add statistics to a scan do not reuse the seeds of the previous ones.
+# The seeds are 31 bit integers; the table of all the seeds of the run is drawn at once, and the seeds which collide 
+# with a previous one are replaced by spare words of the same sequence.
+class seed_par_manager:
+    def __init__(self, mac_dict, master_seed=None, run_index=0):
+        macfile_seed = mac_dict.pop('/mpiForGate/masterSeed', None)
+        if macfile_seed is not None:
+            master_seed = int(macfile_seed[0])
+        self.master_seed = master_seed if master_seed is not None else np.random.SeedSequence().entropy
+        self.run_index = run_index
+        self.table = None
+
+    def build_table(self, n_jobs):
+        words = np.random.SeedSequence(self.master_seed, spawn_key=(self.run_index,)).generate_state(2*n_jobs+16)
+        words = (words & 0x7fffffff).astype(np.int64)
+        self.table = words[:n_jobs]
+        _, first = np.unique(self.table, return_index=True)
+        if len(first) < n_jobs:
+            collisions = np.setdiff1d(np.arange(n_jobs), first)
+            used = set(self.table.tolist())
+            spares = (int(word) for word in words[n_jobs:] if int(word) not in used)
+            for job_n in collisions:
+                self.table[job_n] = next(spares)
+                used.add(int(self.table[job_n]))
     
-    def get_task_per_param(self, seed):
+    # A job which failed is run again (attempt > 0) with a fresh seed, from its own sequence (spawn key of the run, 
+    # job and attempt), which does not collide with the seeds of the table
+    def get_retry_seed(self, job_n, attempt):
+        words = np.random.SeedSequence(self.master_seed, spawn_key=(self.run_index, job_n, attempt)).generate_state(8)
+        for word in (words & 0x7fffffff).astype(np.int64):
+            if not np.any(self.table == word):
+                return int(word)
+        raise Exception('No fresh seed found for the attempt {} of the job {}'.format(attempt, job_n))
+
+    def get_task_per_param(self, job_n, attempt=0):
         commands, values = [], []
         commands.append('/gate/random/setEngineSeed')
-        values.append([seed])
+        values.append([int(self.table[job_n]) if attempt == 0 else self.get_retry_seed(job_n, attempt)])
         return commands, values
     
 
-def get_processed_macfile(macfile_path, new_macfile_path, proj_n, cpu_n):
-    orig_macfile = mf(macfile_path)
-    curr_macfile = copy.deepcopy(orig_macfile) # working on copy because the the managers have destructive reading on some macfile instructions
+# A macfile parsed (and processed by the managers) only once. The lines which depend on the job (placement, source, 
+# output paths, seed) are slots: rendering the macfile of a job only recomputes the slot values and substitutes 
+# them into the pre-formatted lines. The template can be pickled, e.g. to broadcast it from rank 0 to all the ranks.
+# With resolve_includes, the macros called with /control/execute are inlined: the managers see their commands, and 
+# the rendered macfiles are self-contained (GATE does not read the included macros for every job).
+# With adaptive, the number of jobs of each projection (n_splits) is chosen at run time, up to max_splits (by default
+# 4 times nProcesses): the primaries of nProcesses runs are split among them and the number of primaries is a slot.
+# The seeds of the jobs are drawn from master_seed and run_index (see seed_par_manager).
+class macfile_template:
+    def __init__(self, macfile_path, resolve_includes=False, adaptive=False, max_splits=None, master_seed=None, run_index=0):
+        orig_macfile = mf(macfile_path, resolve_includes)
+        curr_macfile = copy.deepcopy(orig_macfile) # working on copy because the the managers have destructive reading on some macfile instructions
 
-    ct   = proj_par_manager(curr_macfile)
-    new_ct_cmds, new_ct_vals   = ct.get_task_per_param(proj_n)
-    curr_macfile.update(new_ct_cmds, new_ct_vals)
-    
-    cpu  = cpu_par_manager(curr_macfile)
-    new_cpu_cmds, new_cpu_vals  = cpu.get_task_per_param(cpu_n)
-    curr_macfile.update(new_cpu_cmds, new_cpu_vals)
-    
-    seed = seed_par_manager(curr_macfile)
-    new_seed_cmds, new_seed_vals = seed.get_task_per_param(cpu.get_total_n_parameters()*proj_n+cpu_n) #assign one particolar seed per simulation
-    curr_macfile.update(new_seed_cmds, new_seed_vals)
+        self.ct = proj_par_manager(curr_macfile)
+        new_ct_cmds, new_ct_vals = self.ct.get_task_per_param(0)
+        curr_macfile.update(new_ct_cmds, new_ct_vals)
+
+        cpu = cpu_par_manager(curr_macfile)
+        self.n_processes = cpu.get_total_n_parameters()
+        new_cpu_cmds, new_cpu_vals = cpu.get_task_per_param(0)
+        curr_macfile.update(new_cpu_cmds, new_cpu_vals)
+
+        self.max_splits = None
+        new_primaries_cmds = []
+        self.primaries = primaries_par_manager(curr_macfile)
+        if adaptive:
+            self.max_splits = max_splits if max_splits is not None else 4*self.n_processes
+            if self.primaries.n_primaries is None:
+                raise Exception('The adaptive splitting needs the number of primaries to be set with /gate/application/setNumberOfPrimariesPerRun')
+            new_primaries_cmds, new_primaries_vals = self.primaries.get_task_per_param(0, self.n_processes, self.n_processes)
+            curr_macfile.update(new_primaries_cmds, new_primaries_vals)
+        # every job has its own seed, also when a projection is split into max_splits jobs
+        self.seed_stride = self.max_splits if self.max_splits is not None else self.n_processes
+
+        self.seed = seed_par_manager(curr_macfile, master_seed, run_index)
+        self.seed.build_table(self.get_n_projs()*self.seed_stride)
+        new_seed_cmds, new_seed_vals = self.seed.get_task_per_param(0)
+        curr_macfile.update(new_seed_cmds, new_seed_vals)
+
+        # It identifies the rendered macfiles: it changes with the (flattened) macfile, with its location, which
+        # relative output paths depend on (macfile_hash), and with the seeds
+        key = (orig_macfile.macfile_path, orig_macfile.commands, orig_macfile.values)
+        self.macfile_hash = hashlib.sha1(repr(key if not adaptive else key+(max_splits,)).encode()).hexdigest()
+        self.hash = hashlib.sha1(repr((self.macfile_hash, self.seed.master_seed, self.seed.run_index)).encode()).hexdigest()
+
+        # The values of the slots before any update: the updates of a job are applied to a small macfile holding 
+        # only these commands, which reproduces macfile.update() on the whole macfile (elementwise update of the 
+        # commands which appear once, replacement of the others).
+        slot_cmds = list(dict.fromkeys(new_ct_cmds + new_cpu_cmds + new_primaries_cmds + new_seed_cmds))
+        self.slot_values = {}
+        for cmd in slot_cmds:
+            if orig_macfile.count(cmd) == 1:
+                self.slot_values[cmd] = orig_macfile.get(cmd)
+
+        cmds, self.lines = curr_macfile.get_lines()
+        self.slot_lines = {cmd: cmds.index(cmd) for cmd in slot_cmds}
+
+    def get_n_projs(self):
+        return self.ct.get_total_n_parameters()
+
+    def get_n_processes(self):
+        return self.n_processes
+
+    # Per-projection metadata stored along with the merged outputs by the container backends: the angle of the 
+    # projection (NaN if the scan is not a rotation), the number of primaries summed over its jobs (-1 if the macfile
+    # does not set it) and the seeds of its jobs (seed_stride of them, some unused in adaptive mode). The projections 
+    # of an energy swipe also get their energy.
+    def get_projection_metadata(self, proj_n):
+        angle = self.ct.projs[proj_n] if self.ct.scan_type == ScanType.CT else np.nan
+        primaries = self.primaries.n_primaries*self.n_processes if self.primaries.n_primaries is not None else -1
+        seeds = self.seed.table[self.seed_stride*proj_n:self.seed_stride*(proj_n+1)]
+        metadata = {'angle': np.float64(angle), 'primaries': np.int64(primaries), 'seed': seeds}
+        if self.ct.scan_type == ScanType.EnergySwipe:
+            metadata['energy'] = np.float64(self.ct.energies[proj_n])
+        return metadata
+
+    # The number of primaries of a job (the job cpu_n of n_splits, in adaptive mode), None if the macfile does not set it
+    def get_job_primaries(self, proj_n, cpu_n, n_splits=None):
+        if self.primaries.n_primaries is None:
+            return None
+        if self.max_splits is None:
+            return self.primaries.n_primaries
+        _, values = self.primaries.get_task_per_param(cpu_n, self.n_processes, n_splits if n_splits is not None else self.n_processes)
+        return values[0][0]
+
+    # Returns the commands and values of the slots for the given job (the job cpu_n of n_splits, in adaptive mode), run
+    # for the attempt-th time (see seed_par_manager.get_retry_seed)
+    def get_job_commands(self, proj_n, cpu_n, n_splits=None, attempt=0):
+        slots = mf()
+        slots.load_commands(self.slot_values.keys(), copy.deepcopy(list(self.slot_values.values())))
+        new_ct_cmds, new_ct_vals = self.ct.get_task_per_param(proj_n)
+        slots.update(new_ct_cmds, new_ct_vals)
+        cpu = cpu_par_manager(slots) # it reads the output paths of the projection
+        new_cpu_cmds, new_cpu_vals = cpu.get_task_per_param(cpu_n)
+        slots.update(new_cpu_cmds, new_cpu_vals)
+        if self.max_splits is not None:
+            new_primaries_cmds, new_primaries_vals = self.primaries.get_task_per_param(cpu_n, self.n_processes, n_splits if n_splits is not None else self.n_processes)
+            slots.update(new_primaries_cmds, new_primaries_vals)
+        new_seed_cmds, new_seed_vals = self.seed.get_task_per_param(self.seed_stride*proj_n+cpu_n, attempt) #assign one particolar seed per simulation
+        slots.update(new_seed_cmds, new_seed_vals)
+        return slots.commands, slots.values
+
+    # Lines to send to a Gate session which has already run a job of this template (see gate_session): the slots of 
+    # the job, as written in its macfile (e.g. with outputs redirected by localize_macfile), and the start of the run
+    def get_session_commands(self, job_macfile_path):
+        job_macfile = mf(job_macfile_path)
+        return [format_line(cmd, job_macfile.get(cmd)) for cmd in self.slot_lines] + [self.lines[-1]]
+
+    def render(self, new_macfile_path, proj_n, cpu_n, n_splits=None, attempt=0):
+        lines = list(self.lines)
+        for cmd, value in zip(*self.get_job_commands(proj_n, cpu_n, n_splits, attempt)):
+            lines[self.slot_lines[cmd]] = format_line(cmd, value)
+        with open(new_macfile_path, 'w') as f:
+            f.writelines(lines)
+
+def get_processed_macfile(macfile_path, new_macfile_path, proj_n, cpu_n):
+    macfile_template(macfile_path).render(new_macfile_path, proj_n, cpu_n)
     
+# Writes a copy of the (already processed) macfile whose image outputs are redirected into local_dir, e.g. a
+# node-local scratch folder. The output paths are mirrored below local_dir, so that outputs do not clash.
+def localize_macfile(macfile_path, new_macfile_path, local_dir):
+    curr_macfile = mf(macfile_path)
+    local_outfiles = []
+    for cmd in ['/gate/output/ProcessCT/setFileName', '/gate/output/ProcessCT/setScatterFileName']:
+        outfile = curr_macfile.get(cmd)
+        if outfile is not None:
+            local_outfile = os.path.join(local_dir, os.path.abspath(outfile[0]).lstrip(os.sep))
+            curr_macfile.update(cmd, [local_outfile])
+            local_outfiles.append(local_outfile)
     curr_macfile.write(new_macfile_path)
+    return local_outfiles
     
 def get_processCT_info_from_macfile(macfile_path):
     orig_macfile = mf(macfile_path)
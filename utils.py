@@ -17,14 +17,21 @@
 
 from datetime import datetime
 from enum import Enum
-import mpi4py, sys
+import mpi4py, os, sys
+import numpy as np
 import macfile
 
 class signals(Enum):
-    READ  = 0 
-    WRITE = 1 
-    CLOSE = 2
-    DONE  = 3
+    READ    = 0 
+    WRITE   = 1 
+    CLOSE   = 2
+    DONE    = 3
+    REQUEST = 4
+    WORK    = 5
+    REDUCED = 6
+    ERROR   = 7
+    FAILED  = 8
+    ACK     = 9
 
 class states(Enum):
     SLEEPING       = 0
@@ -33,6 +40,15 @@ class states(Enum):
     WRITING        = 3
     DONE           = 4
     
+# MPI tag of the image buffers sent along with a DONE signal, on their own communicator (see messaging)
+IMAGE_TAG  = 1
+
+# The dtypes of the images which can be sent over MPI, by index
+image_dtypes = [np.float32, np.float64, np.int32, np.uint32, np.int16, np.uint16, np.uint8]
+
+def get_image_dtype_code(dtype):
+    return [np.dtype(image_dtype) for image_dtype in image_dtypes].index(np.dtype(dtype))
+
 def getTimeString():
     return datetime.now().strftime("%H:%M:%S")
 
@@ -83,6 +99,19 @@ def getOutputRootFile(mac_file):
     return output
 
 
+# Removes the outputs a job may have left (e.g. a job which failed), so that they are not merged
+def removeOutputFiles(mac_file):
+    output_root_file = getOutputRootFile(mac_file)
+    for output_file in getOutputImageFiles(mac_file) + ([output_root_file, output_root_file+'.root'] if output_root_file is not None else []):
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+# Threads do not go through sys.excepthook: without this hook, an uncaught exception would only end the thread (e.g.
+# a thread of the manager), and the other ranks would wait for it forever
+def global_thread_except_hook(args):
+    if args.exc_type is not SystemExit:
+        global_except_hook(args.exc_type, args.exc_value, args.exc_traceback)
+
 def global_except_hook(exctype, value, traceback):
     import sys
     try:
@@ -97,6 +126,11 @@ def global_except_hook(exctype, value, traceback):
         sys.stderr.write("Calling MPI_Abort() to shut down MPI processes...\n")
         sys.stderr.flush()
     finally:
+        try: # the buffered logs are written, unless it takes too long
+            from logger import flush_logs
+            flush_logs(timeout=5)
+        except Exception:
+            pass
         try:
             import mpi4py.MPI
             mpi4py.MPI.COMM_WORLD.Abort(1)